@@ -0,0 +1,240 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import AsyncIterable, Callable, NamedTuple, Union
+
+import aiohttp
+
+from cache import ResultCache, SingleFlight, make_key
+from config import (API_BASE_URL, API_POOL_LIMIT, API_KEEPALIVE_TIMEOUT, API_DNS_CACHE_TTL, API_TIMEOUT,
+                    API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_RETRIES, API_RETRY_BASE, API_RETRY_MAX, API_HEDGE,
+                    API_BREAKER_FAILURES, API_BREAKER_RESET)
+from metrics import counter, gauge, span
+from resilience import CircuitBreaker, LatencyWindow, backoff_delay
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# answers worth another try: the backend is overloaded or restarting
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+# failures before the request reached the backend; after that (a read timeout, a dropped connection)
+# it may already be working on the request, and a POST is not sent again
+RETRY_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+# file contents for an upload: raw bytes or chunks streamed into the multipart body
+FileData = Union[bytes, AsyncIterable[bytes]]
+# a zero-argument callable opening a fresh FileData can be sent again on retry,
+# a bare chunk stream only once
+FileSource = Union[FileData, Callable[[], FileData]]
+
+
+class ApiResponse(NamedTuple):
+    status: int
+    text: str
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ApiUnavailable(Exception):
+    """The backend could not be reached, or the circuit breaker is open."""
+
+
+def _replayable(file_data: FileSource) -> bool:
+    return isinstance(file_data, bytes) or callable(file_data)
+
+
+def _open(file_data: FileSource) -> FileData:
+    return file_data() if callable(file_data) else file_data
+
+
+class ApiClient:
+    """Client for the etf-team.ru API sharing one pooled keep-alive session.
+
+    Every call has a connect and a read deadline per attempt and an overall
+    one. Failures to connect and RETRY_STATUSES are retried with jittered
+    exponential backoff between ``retry_base`` and ``retry_max`` seconds,
+    when the request body can be sent again; other errors raise ApiUnavailable
+    at once.
+    With ``hedge``, a call still running after the endpoint's p95 latency gets
+    a second copy and the first good answer wins. After ``breaker_failures``
+    failed calls in a row the client raises ApiUnavailable at once for
+    ``breaker_reset`` seconds.
+    """
+
+    def __init__(self, base_url: str = API_BASE_URL, pool_limit: int = API_POOL_LIMIT,
+                 keepalive_timeout: float = API_KEEPALIVE_TIMEOUT, dns_cache_ttl: int = API_DNS_CACHE_TTL,
+                 timeout: float = API_TIMEOUT, cache: ResultCache = None, connect_timeout: float = API_CONNECT_TIMEOUT,
+                 read_timeout: float = API_READ_TIMEOUT, retries: int = API_RETRIES, retry_base: float = API_RETRY_BASE,
+                 retry_max: float = API_RETRY_MAX, hedge: bool = API_HEDGE,
+                 breaker_failures: int = API_BREAKER_FAILURES, breaker_reset: float = API_BREAKER_RESET):
+        self.base_url = base_url
+        self.pool_limit = pool_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.hedge = hedge
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.cache = cache
+        self.flights = SingleFlight()
+        self.retried = 0
+        self.hedged = 0
+        self._latency = defaultdict(LatencyWindow)
+        self._session = None
+
+    async def start(self):
+        counter("bot_coalesced_requests_total", "API calls that joined an identical call in flight",
+                lambda: self.flights.shared)
+        counter("bot_api_retries_total", "API attempts repeated after a failure", lambda: self.retried)
+        counter("bot_api_hedged_total", "API calls that got a hedged second request", lambda: self.hedged)
+        counter("bot_api_circuit_opened_total", "Times the API circuit breaker opened", lambda: self.breaker.opened)
+        gauge("bot_api_circuit_open", "1 while calls to the API fail fast", lambda: int(self.breaker.is_open))
+        if self.cache is not None:
+            counter("bot_result_cache_hits_total", "API results served from the cache", lambda: self.cache.hits)
+            counter("bot_result_cache_misses_total", "API results not found in the cache", lambda: self.cache.misses)
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(base_url=self.base_url, connector=connector)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _attempt(self, path: str, kwargs: dict, deadline: float) -> ApiResponse:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        timeout = aiohttp.ClientTimeout(total=remaining, connect=self.connect_timeout, sock_read=self.read_timeout)
+        started_at = time.monotonic()
+        with span("upstream_api", endpoint=path):
+            async with self._session.post(path, timeout=timeout, **kwargs) as response:
+                result = ApiResponse(response.status, await response.text())
+        if result.status < 500:
+            self._latency[path].add(time.monotonic() - started_at)
+        return result
+
+    async def _hedged(self, path: str, make_kwargs, deadline: float, replayable: bool) -> ApiResponse:
+        delay = self._latency[path].percentile(95) if self.hedge and replayable else None
+        first = asyncio.ensure_future(self._attempt(path, make_kwargs(), deadline))
+        if delay is None:
+            return await first
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+            self.hedged += 1
+            tasks.append(asyncio.ensure_future(self._attempt(path, make_kwargs(), deadline)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status not in RETRY_STATUSES:
+                        return task.result()
+            # both copies failed, report the last one
+            return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _post(self, path: str, make_kwargs, replayable: bool = True, timeout: float = None) -> ApiResponse:
+        """POST with retries; ``make_kwargs()`` builds the request, once per attempt."""
+        if self._session is None:
+            raise RuntimeError("ApiClient is not started")
+        if not self.breaker.allow():
+            raise ApiUnavailable(f"{path}: circuit breaker is open")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempts = self.retries + 1 if replayable else 1
+        response = error = None
+        for attempt in range(attempts):
+            try:
+                response = await self._hedged(path, make_kwargs, deadline, replayable)
+            except RETRY_ERRORS as e:
+                response, error = None, e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.breaker.failure()
+                raise ApiUnavailable(f"{path}: {type(e).__name__}: {e}") from e
+            else:
+                if response.status not in RETRY_STATUSES:
+                    if response.status < 500:
+                        self.breaker.success()
+                    else:
+                        self.breaker.failure()
+                    return response
+            delay = backoff_delay(attempt, self.retry_base, self.retry_max)
+            if attempt + 1 == attempts or time.monotonic() + delay >= deadline:
+                break
+            self.retried += 1
+            await asyncio.sleep(delay)
+        self.breaker.failure()
+        if response is not None:
+            return response
+        raise ApiUnavailable(f"{path}: {type(error).__name__}: {error}") from error
+
+    async def _cached_post(self, cache_key: str, path: str, make_kwargs, **kwargs) -> ApiResponse:
+        if cache_key is None:
+            return await self._post(path, make_kwargs, **kwargs)
+        if self.cache is not None:
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return ApiResponse(*cached)
+
+        async def call():
+            response = await self._post(path, make_kwargs, **kwargs)
+            if self.cache is not None and response.status in (200, 201):
+                await self.cache.set(cache_key, list(response))
+            return response
+
+        # identical concurrent requests share the first one's upstream call
+        return await self.flights.do(cache_key, call)
+
+    @staticmethod
+    def _upload(file_data: FileSource, filename: str, **kwargs):
+        def make_kwargs():
+            form = aiohttp.FormData()
+            form.add_field(name="payload", value=_open(file_data), filename=filename,
+                           content_type=XLSX_CONTENT_TYPE)
+            return {"data": form, **kwargs}
+        return make_kwargs
+
+    async def volumes_info(self, file_data: FileSource, filename: str, content_key: str = None,
+                           timeout: float = None) -> ApiResponse:
+        cache_key = make_key("volumes-info", content_key) if content_key else None
+        make_kwargs = self._upload(file_data, filename, params={"return_resolved": "true"})
+        return await self._cached_post(cache_key, "/api/volumes-info", make_kwargs,
+                                       replayable=_replayable(file_data), timeout=timeout)
+
+    async def volumes_info_manual(self, payload: dict, timeout: float = None) -> ApiResponse:
+        cache_key = make_key("volumes-info-manual", payload)
+        return await self._cached_post(cache_key, "/api/volumes-info",
+                                       lambda: {"params": {"return_resolved": "true"}, "json": payload},
+                                       timeout=timeout)
+
+    async def client_cases(self, file_data: FileSource, filename: str, voltage_category: str,
+                           is_transmission_included: bool, max_power_capacity_kwt: int,
+                           content_key: str = None, timeout: float = None) -> ApiResponse:
+        """Post a workbook to /api/clients/cases.
+
+        ``content_key`` identifies the workbook contents (see files.content_key);
+        when given, the response is cached together with the query parameters,
+        identical concurrent calls share one upstream request and a cache hit or
+        a shared call never touches ``file_data``.
+        """
+        params = {
+            "is_transmission_included": "true" if is_transmission_included else "false",
+            "max_power_capacity_kwt": str(max_power_capacity_kwt),
+            "voltage_category": voltage_category,
+        }
+        cache_key = make_key("clients-cases", content_key, params) if content_key else None
+        make_kwargs = self._upload(file_data, filename, params=params, headers={"accept": "application/json"})
+        return await self._cached_post(cache_key, "/api/clients/cases", make_kwargs,
+                                       replayable=_replayable(file_data), timeout=timeout)
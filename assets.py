@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+from typing import Awaitable, Callable
+
+from aiogram.types import BufferedInputFile, Message
+
+import db
+from config import STATIC_DIR, HELLO_PIC_FILE_ID, SAD_PIC_FILE_ID, HA_PIC_FILE_ID, HAHA_PIC_FILE_ID
+from log import log, log_error
+
+# name -> (file in STATIC_DIR, file_id to send when the file is missing)
+PICTURES = {
+    "hello": ("hello_pic.png", HELLO_PIC_FILE_ID),
+    "sad": ("sad_pic.png", SAD_PIC_FILE_ID),
+    "ha": ("ha_pic.png", HA_PIC_FILE_ID),
+    "haha": ("haha_pic.png", HAHA_PIC_FILE_ID),
+}
+
+
+def _read(path: str) -> tuple:
+    with open(path, "rb") as f:
+        data = f.read()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def _stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _sent_file_id(message: Message) -> str:
+    if message.photo:
+        return message.photo[-1].file_id
+    return (message.document or message.video or message.animation or message.audio).file_id
+
+
+class Asset:
+    def __init__(self, name: str, path: str, fallback_file_id: str = None, keep_data: bool = False):
+        self.name = name
+        self.path = path
+        self.fallback_file_id = fallback_file_id
+        self.keep_data = keep_data
+        self.file_id = None
+        self.sha256 = None
+        self.data = None
+        self.stamp = None
+        self.lock = asyncio.Lock()
+
+
+class AssetRegistry:
+    """Static files sent to users, uploaded once and then sent by Telegram file_id.
+
+    The file_id returned by the first upload is kept in SQLite with the file's
+    sha256, so it survives restarts and is dropped when the file changes. A
+    file missing on disk is sent by its fallback file_id instead.
+    """
+
+    def __init__(self):
+        self._assets = {}
+        self._bot_id = None
+
+    def add(self, name: str, path: str, fallback_file_id: str = None, keep_data: bool = False):
+        """Register a file; with ``keep_data`` its bytes stay in memory for ``data()``."""
+        self._assets[name] = Asset(name, path, fallback_file_id, keep_data)
+
+    def add_pictures(self, static_dir: str = STATIC_DIR):
+        for name, (filename, fallback_file_id) in PICTURES.items():
+            self.add(name, os.path.join(static_dir, filename), fallback_file_id)
+
+    async def _refresh(self, asset: Asset) -> bool:
+        """Re-read the file if it changed on disk; False when there is no file."""
+        stamp = _stamp(asset.path)
+        if stamp is None:
+            asset.data = asset.sha256 = asset.file_id = asset.stamp = None
+            return False
+        if stamp == asset.stamp:
+            return True
+        data, sha256 = await asyncio.to_thread(_read, asset.path)
+        if sha256 != asset.sha256:
+            asset.sha256 = sha256
+            asset.file_id = None
+            record = await db.get_asset(self._bot_id, asset.name)
+            if record is not None and record[0] == sha256:
+                asset.file_id = record[1]
+        asset.stamp = stamp
+        asset.data = data if asset.keep_data else None
+        return True
+
+    async def load(self, bot_id: int):
+        self._bot_id = bot_id
+        for asset in self._assets.values():
+            if not await self._refresh(asset) and asset.fallback_file_id is None:
+                log("asset missing", path=asset.path, name=asset.name)
+
+    async def send(self, name: str, send: Callable[..., Awaitable[Message]], **kwargs) -> Message:
+        """Call ``send(file, **kwargs)``, e.g. ``message.answer_photo``, with the asset as ``file``."""
+        asset = self._assets[name]
+        if not await self._refresh(asset):
+            if asset.fallback_file_id is None:
+                raise FileNotFoundError(asset.path)
+            return await send(asset.fallback_file_id, **kwargs)
+        if asset.file_id is None:
+            async with asset.lock:
+                # concurrent first sends wait for one upload instead of each uploading the file
+                if asset.file_id is None:
+                    data = asset.data
+                    if data is None:
+                        data, _ = await asyncio.to_thread(_read, asset.path)
+                    message = await send(BufferedInputFile(data, os.path.basename(asset.path)), **kwargs)
+                    try:
+                        asset.file_id = _sent_file_id(message)
+                        await db.set_asset(self._bot_id, asset.name, asset.sha256, asset.file_id)
+                    except Exception as e:
+                        log_error("asset file_id not saved", e, name=asset.name)
+                    return message
+        return await send(asset.file_id, **kwargs)
+
+    async def data(self, name: str) -> bytes:
+        """Contents of a ``keep_data`` asset, read from disk only when it changed."""
+        asset = self._assets[name]
+        if not await self._refresh(asset):
+            raise FileNotFoundError(asset.path)
+        return asset.data
+
+    def content_key(self, name: str) -> str:
+        """Same form as files.content_key for the asset's current contents."""
+        return f"sha256:{self._assets[name].sha256}"
@@ -0,0 +1,1263 @@
+"""Offline load test: a bot against local stand-ins for the Bot API and etf-team.ru.
+
+    python bench.py [--bot main_nomanual|main] [--mode polling|webhook|polling,webhook] [--workers N]
+                    [--users 200] [--concurrency 10,50] [--tg-latency 0.02] [--api-latency 0.3] ...
+
+Each run writes a throwaway keys.py into a temporary directory, starts the bot
+in a child process (through shard.py when --workers is given) and drives
+scripted user journeys at the chosen concurrency. Every step sends one
+update and waits for the bot's final reply to it. With --mode
+polling,webhook both modes run under the same load, one after the other
+for each concurrency, so their updates/s and step latencies line up.
+
+The fake API can answer errors, slow down or hang for a share of calls
+(--api-error-rate, --api-slow-rate, --api-hang-rate), and its peak number
+of calls in flight is reported. This shows how retries, hedging
+(--set API_HEDGE=True) and the circuit breaker affect tail latency and pile-up.
+
+Results go to stdout and are appended to bench_output.txt: updates/s,
+p50/p95/p99 latency per step and per journey, API call counts, the most new
+messages the bot posted within one second and peak RSS.
+For the bot process, the largest single process is reported together with
+the whole process tree (intake plus workers).
+
+Uploads are generated meter readings workbooks covering --days days. With
+--parse N the bot is not started; instead parse_workbook is timed N times on
+year-long workbooks in each supported layout and on malformed uploads. With
+--costs N the local cost engine prices N generated profiles, one at a time
+and as a batch. Answers the bot gave from the local engine because the API
+was down are counted as "local" journeys.
+
+With --starts N, N users send /start at the same moment against a fresh
+users.db, first as new users and then as returning ones. The registration
+the bot started with (a connection, a SELECT and an INSERT or UPDATE per
+call), one UPSERT on the shared connection and the write-behind buffer the
+bot uses now are compared by starts/s, commits/s and p50/p99 latency; the
+write-behind round lasts until its rows are committed.
+
+With --api N, N uploads to the fake /api/clients/cases (--concurrency at a
+time, the first value) go through a new aiohttp session per call, as the
+bot first did, and then through the pooled ApiClient. Latency percentiles
+and the number of TCP connections the fake API saw are reported; with
+--api-latency 0 only the client's own overhead is left.
+
+With --upload MB, a workbook of that size is served by the fake Bot API and
+streamed through validation and then into the API client, both under
+tracemalloc. Either one peaking above --memory-ceiling fails the run (exit
+status 1). Downloading the file into memory and posting the bytes, as the
+bot did before streaming, is measured alongside for reference.
+
+With --coalesce N, N identical calls are sent at once three times: while
+the fake API answers --api-error-code, after it recovers and once more. The
+first two rounds must each reach the API exactly once, with every caller
+getting the same answer. The error must not be cached, and the last round
+must be served from the cache. Anything else fails the run.
+
+With --resilience N, a fresh fake API fails in a different way for each
+check. The run fails unless:
+- an --api-error-code answer is tried exactly retries + 1 times;
+- a read timeout is not retried;
+- the circuit breaker opens after its failures and then fails N calls at
+  once without reaching the API;
+- N calls to a hanging API never have more than the pool in flight, and all
+  end by the overall deadline.
+
+With --fsm N, N dialogs (--concurrency at a time) go through the states of
+main_nomanual's form, with MemoryStorage and with SQLiteStorage, with its
+cache and without it, as for webhook instances behind a load balancer.
+State transitions per second are reported; the SQLite runs are timed until
+their writes are committed.
+"""
+import argparse
+import asyncio
+import datetime
+import importlib
+import io
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from collections import Counter, defaultdict
+from functools import partial
+
+import aiohttp
+import aiosqlite
+import openpyxl
+from aiohttp import web
+
+OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_output.txt")
+TARIFFS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "tariffs.json")
+TOKEN = "123456:bench"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+FIRST_CHAT_ID = 10_000_000
+WARMUP_CHAT_ID = 1_000_000
+SAD_PIC = "sad-pic"
+HAHA_PIC = "haha-pic"
+UPDATE_BATCH = 100
+STOP_TIMEOUT = 60
+RSS_SAMPLE_INTERVAL = 0.2
+QUIET_PERIOD = 0.5
+SEND_CHUNK_SIZE = 64 * 1024
+
+KEYS_TEMPLATE = """\
+API_TOKEN = {token!r}
+HELLO_PIC_FILE_ID = "hello-pic"
+SAD_PIC_FILE_ID = {sad!r}
+HA_PIC_FILE_ID = "ha-pic"
+HAHA_PIC_FILE_ID = {haha!r}
+TEST_FILE_PATH = {test_file!r}
+TELEGRAM_API_URL = {telegram_url!r}
+API_BASE_URL = {api_url!r}
+METRICS_PORT = None
+TARIFFS_PATH = {tariffs!r}
+"""
+
+# /start as the bot wrote it before the shared connection: SELECT, then INSERT or UPDATE
+SELECT_USER = "SELECT 1 FROM users WHERE user_id = ?"
+INSERT_USER = "INSERT INTO users (user_id, username, strt) VALUES (?, ?, 1)"
+UPDATE_USER = "UPDATE users SET username = ? WHERE user_id = ?"
+# and as one statement on the shared connection, RETURNING tells a new user from a returning one
+UPSERT_USER = """
+    INSERT INTO users (user_id, username, strt, starts) VALUES (?, ?, 1, 1)
+    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, starts = starts + 1
+    RETURNING starts
+"""
+
+CATEGORY_TYPES = ("FIRST", "SECOND", "THIRD", "FORTH")
+ERROR_RESPONSES = {500: web.HTTPInternalServerError, 502: web.HTTPBadGateway, 503: web.HTTPServiceUnavailable,
+                   504: web.HTTPGatewayTimeout}
+HANG_SECONDS = 3600
+WORKBOOK_START = datetime.date(2025, 1, 1)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def _jitter(latency: float) -> float:
+    return latency * random.uniform(0.5, 1.5) if latency > 0 else 0
+
+
+def meter_workbook(days: int, layout: str = "wide") -> bytes:
+    """Hourly readings for ``days`` days: a row per day, or per hour with "long"."""
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet("Показания")
+    sheet.append(["Потребление электроэнергии, кВт*ч"])
+    sheet.append(["Дата"] + (list(range(1, 25)) if layout == "wide" else ["Час", "кВт*ч"]))
+    for day in range(days):
+        date = WORKBOOK_START + datetime.timedelta(days=day)
+        hourly = [round(random.uniform(20, 80) * (1.5 if 8 <= hour < 20 else 1), 3) for hour in range(24)]
+        if layout == "wide":
+            sheet.append([date] + hourly)
+        else:
+            for hour, value in enumerate(hourly, start=1):
+                sheet.append([date, hour, value])
+    sheet.append(["Итого", None, None])
+    output = io.BytesIO()
+    book.save(output)
+    return output.getvalue()
+
+
+def padded_workbook(days: int, size: int) -> bytes:
+    """A meter workbook grown to ``size`` bytes by a stored, incompressible picture, as in exports with a logo."""
+    output = io.BytesIO(meter_workbook(days))
+    with zipfile.ZipFile(output, "a") as archive:
+        archive.writestr(zipfile.ZipInfo("xl/media/image1.png"), os.urandom(max(0, size - len(output.getvalue()))))
+    return output.getvalue()
+
+
+class FakeTelegram:
+    """Stand-in for the Bot API: feeds queued updates and records every bot call per chat."""
+
+    def __init__(self, latency: float, error_rate: float, error_code: int, file_bytes: bytes):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.file_bytes = file_bytes
+        self.updates = asyncio.Queue()
+        self.calls = Counter()
+        self.errors = 0
+        # when each new message (the calls Telegram's global limit counts) was posted
+        self.sent_at = []
+        self.webhook_secret = ""
+        self.ready = asyncio.Event()
+        self.last_call_at = time.monotonic()
+        self._outboxes = defaultdict(asyncio.Queue)
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.download)
+        return app
+
+    def peak_send_rate(self, window: float = 1.0) -> int:
+        """Most new messages posted within any ``window`` seconds."""
+        peak, first = 0, 0
+        for last, at in enumerate(self.sent_at):
+            while at - self.sent_at[first] >= window:
+                first += 1
+            peak = max(peak, last - first + 1)
+        return peak
+
+    def outbox(self, chat_id: int) -> asyncio.Queue:
+        return self._outboxes[chat_id]
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": chat_id, "type": "private"}, **fields}
+
+    async def _get_updates(self, params: dict) -> list:
+        self.ready.set()
+        timeout = float(params.get("timeout") or 0)
+        try:
+            updates = [await asyncio.wait_for(self.updates.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(updates) < UPDATE_BATCH and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    def _result(self, method: str, params: dict):
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if method == "getMe":
+            return BOT_USER
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.file_bytes),
+                    "file_path": f"documents/{file_id}.xlsx"}
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = params.get("photo")
+            return self._message(chat_id, caption=params.get("caption", ""),
+                                 photo=[{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}])
+        if method == "sendDocument":
+            return self._message(chat_id, caption=params.get("caption", ""),
+                                 document={"file_id": "test-file", "file_unique_id": "test-file"})
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        self.last_call_at = time.monotonic()
+        if method.startswith(("send", "forward", "copy")) and method != "sendChatAction":
+            self.sent_at.append(self.last_call_at)
+        if method == "setWebhook":
+            self.webhook_secret = params.get("secret_token", "")
+            self.ready.set()
+        await asyncio.sleep(_jitter(self.latency))
+        if method not in ("getMe", "setWebhook", "deleteWebhook") and random.random() < self.error_rate:
+            self.errors += 1
+            description = "Too Many Requests: retry after 1" if self.error_code == 429 else "Internal Server Error"
+            return web.json_response({"ok": False, "error_code": self.error_code, "description": description,
+                                      "parameters": {"retry_after": 1}}, status=self.error_code)
+        result = self._result(method, params)
+        if "chat_id" in params:
+            self.outbox(int(params["chat_id"])).put_nowait((method, params, result))
+        return web.json_response({"ok": True, "result": result})
+
+    async def idle(self, quiet: float):
+        """Wait until the bot has made no calls for ``quiet`` seconds."""
+        while time.monotonic() - self.last_call_at < quiet:
+            await asyncio.sleep(quiet / 4)
+
+    async def download(self, request: web.Request) -> web.Response:
+        self.calls["download"] += 1
+        await asyncio.sleep(_jitter(self.latency))
+        # written chunk by chunk so that a large file is not copied into the transport's buffer
+        response = web.StreamResponse()
+        response.content_length = len(self.file_bytes)
+        await response.prepare(request)
+        view = memoryview(self.file_bytes)
+        for offset in range(0, len(view), SEND_CHUNK_SIZE):
+            await response.write(view[offset:offset + SEND_CHUNK_SIZE])
+        await response.write_eof()
+        return response
+
+
+class FakeEtfApi:
+    """Stand-in for /api/volumes-info and /api/clients/cases."""
+
+    def __init__(self, latency: float, error_rate: float, error_code: int = 503, slow_rate: float = 0,
+                 slow_latency: float = 0, hang_rate: float = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.hang_rate = hang_rate
+        self.calls = Counter()
+        self.errors = 0
+        self.bytes_received = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        # client ends of the TCP connections the calls came over
+        self.peers = set()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/api/volumes-info", self.volumes_info)
+        app.router.add_post("/api/clients/cases", self.client_cases)
+        return app
+
+    async def _receive(self, request: web.Request, name: str):
+        self.calls[name] += 1
+        self.peers.add(request.transport.get_extra_info("peername"))
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            async for chunk in request.content.iter_any():
+                self.bytes_received += len(chunk)
+            draw = random.random()
+            if draw < self.hang_rate:
+                # never answers; the handler is cancelled when the client gives up
+                await asyncio.sleep(HANG_SECONDS)
+            elif draw < self.hang_rate + self.slow_rate:
+                await asyncio.sleep(_jitter(self.slow_latency))
+            else:
+                await asyncio.sleep(_jitter(self.latency))
+        finally:
+            self.in_flight -= 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise ERROR_RESPONSES[self.error_code](text="bench upstream error")
+
+    async def volumes_info(self, request: web.Request) -> web.Response:
+        await self._receive(request, "volumes-info")
+        return web.json_response({"volumes": [{"month": month, "kwh": 1000.0 * month} for month in range(1, 13)]})
+
+    async def client_cases(self, request: web.Request) -> web.Response:
+        await self._receive(request, "clients-cases")
+        power = int(request.query.get("max_power_capacity_kwt", 0))
+        categories = [
+            {"category_type": category_type, "total_cost": 250000.0 * (index + 1),
+             "applicability": {"is_applicable_power_capacity": power < 670,
+                               "power_capacity_change_recommendation": max(0, power - 670)}}
+            for index, category_type in enumerate(CATEGORY_TYPES)
+        ]
+        return web.json_response({"categories": categories})
+
+
+def _user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": "bench", "username": f"user{chat_id}"}
+
+
+def text_message(chat_id: int, text: str) -> dict:
+    message = {"message_id": 0, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+               "from": _user(chat_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+def document_message(chat_id: int, file_unique_id: str, file_size: int) -> dict:
+    return {"message": {
+        "message_id": 0, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+        "from": _user(chat_id),
+        "document": {"file_id": f"doc-{file_unique_id}", "file_unique_id": file_unique_id,
+                     "file_name": "meter.xlsx", "file_size": file_size},
+    }}
+
+
+def callback(chat_id: int, data: str, last_message: dict) -> dict:
+    return {"callback_query": {"id": f"cb-{chat_id}-{time.monotonic_ns()}", "from": _user(chat_id),
+                               "chat_instance": str(chat_id), "data": data, "message": last_message}}
+
+
+def _text(params: dict) -> str:
+    return params.get("text") or params.get("caption") or ""
+
+
+def after_processing(processing_text: str):
+    """Final reply of a step whose bot first posts ``processing_text`` and edits in queue positions."""
+    def final(method: str, params: dict) -> bool:
+        if method == "sendPhoto":
+            return True
+        return method in ("sendMessage", "editMessageText") and not _text(params).startswith(processing_text)
+    return final
+
+
+def expect(*methods):
+    return lambda method, params: method in methods
+
+
+def outcome(method: str, params: dict) -> str:
+    if method == "sendPhoto" and params.get("photo") == SAD_PIC:
+        return "error"
+    if params.get("photo") == HAHA_PIC and "все цифры предварительные" in _text(params):
+        return "local"
+    if params.get("photo") == HAHA_PIC or _text(params).startswith("Ответ"):
+        return "ok"
+    return "rejected"
+
+
+# step name -> (update builder, predicate matching the bot's final reply to it)
+JOURNEYS = {
+    "main_nomanual": [
+        ("start", lambda chat, ctx: text_message(chat, "/start"), expect("sendPhoto")),
+        ("upload", lambda chat, ctx: document_message(chat, ctx.file_unique_id, ctx.file_size),
+         after_processing("Обрабатываю файл...")),
+        ("voltage", lambda chat, ctx: callback(chat, "BH", ctx.last), expect("editMessageText")),
+        ("contract", lambda chat, ctx: callback(chat, "contract_true", ctx.last), expect("editMessageText")),
+        ("max_power", lambda chat, ctx: text_message(chat, "700"),
+         after_processing("Отправляю данные на сервер...")),
+    ],
+    "main": [
+        ("start", lambda chat, ctx: text_message(chat, "/start"), expect("sendPhoto")),
+        ("upload", lambda chat, ctx: document_message(chat, ctx.file_unique_id, ctx.file_size),
+         after_processing("Обрабатываю файл...")),
+        ("manual", lambda chat, ctx: callback(chat, "manual_input", ctx.last), expect("sendMessage")),
+        ("kwh", lambda chat, ctx: text_message(chat, "1500"), expect("sendMessage")),
+        ("max_power", lambda chat, ctx: text_message(chat, "150"), expect("sendMessage")),
+        ("voltage", lambda chat, ctx: callback(chat, "voltage_high", ctx.last),
+         after_processing("Обработка данных...")),
+    ],
+}
+# steps whose reply carries the result of an upstream call
+RESULT_STEPS = {"main_nomanual": ("max_power",), "main": ("upload", "voltage")}
+
+
+class JourneyContext:
+    def __init__(self, file_unique_id: str, file_size: int):
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+        self.last = None
+
+
+class Driver:
+    """Delivers updates to the bot, by getUpdates or by webhook, and waits for its replies."""
+
+    def __init__(self, telegram: FakeTelegram, args, webhook_url: str = None):
+        self.telegram = telegram
+        self.args = args
+        self.webhook_url = webhook_url
+        self.step_latency = defaultdict(list)
+        self.journey_latency = []
+        self.outcomes = Counter()
+        self.updates_answered = 0
+        self._update_ids = itertools.count(1)
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def deliver(self, update: dict):
+        update["update_id"] = next(self._update_ids)
+        if self.webhook_url is None:
+            self.telegram.updates.put_nowait(update)
+            return
+        # like Telegram, retry until the bot accepts the update
+        while True:
+            try:
+                async with self._session.post(self.webhook_url, json=update,
+                                              headers={"X-Telegram-Bot-Api-Secret-Token":
+                                                       self.telegram.webhook_secret}) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.05)
+
+    async def _wait_reply(self, chat_id: int, final) -> tuple:
+        outbox = self.telegram.outbox(chat_id)
+        while True:
+            method, params, result = await outbox.get()
+            if final(method, params):
+                return method, params, result
+
+    async def step(self, chat_id: int, name: str, build, final, ctx: JourneyContext) -> tuple:
+        started_at = time.perf_counter()
+        await self.deliver(build(chat_id, ctx))
+        method, params, result = await asyncio.wait_for(self._wait_reply(chat_id, final), self.args.step_timeout)
+        self.step_latency[name].append(time.perf_counter() - started_at)
+        self.updates_answered += 1
+        if isinstance(result, dict):
+            ctx.last = result
+        return method, params
+
+    async def journey(self, index: int, semaphore: asyncio.Semaphore):
+        chat_id = FIRST_CHAT_ID + index
+        file_unique_id = "bench-file" if self.args.same_file else f"file-{index}"
+        ctx = JourneyContext(file_unique_id, len(self.telegram.file_bytes))
+        async with semaphore:
+            started_at = time.perf_counter()
+            result = "ok"
+            for name, build, final in JOURNEYS[self.args.bot]:
+                try:
+                    method, params = await self.step(chat_id, name, build, final, ctx)
+                except asyncio.TimeoutError:
+                    self.outcomes["timeout"] += 1
+                    return
+                if name in RESULT_STEPS[self.args.bot]:
+                    result = outcome(method, params)
+                    if result != "ok":
+                        break
+                if self.args.think_time:
+                    await asyncio.sleep(self.args.think_time)
+            self.outcomes[result] += 1
+            if result == "ok":
+                self.journey_latency.append(time.perf_counter() - started_at)
+
+    async def warm_up(self, processes: int):
+        """Wait until every bot process answers, so startup is not counted as latency."""
+        ctx = JourneyContext("warmup", 0)
+        name, build, final = JOURNEYS[self.args.bot][0]
+        await asyncio.gather(*(
+            asyncio.wait_for(self.deliver(build(WARMUP_CHAT_ID + index, ctx)), STOP_TIMEOUT)
+            for index in range(processes)
+        ))
+        await asyncio.gather(*(
+            asyncio.wait_for(self._wait_reply(WARMUP_CHAT_ID + index, final), STOP_TIMEOUT)
+            for index in range(processes)
+        ))
+
+
+def _run_bot(module_name: str, workers: int, log_level: int):
+    import log
+    log.logger.setLevel(log_level)
+    logging.getLogger("aiogram").setLevel(log_level if log_level < logging.WARNING else logging.CRITICAL)
+    try:
+        if workers:
+            import shard
+            asyncio.run(shard.ShardedRunner(module_name, workers).run())
+        else:
+            asyncio.run(importlib.import_module(module_name).main())
+    except KeyboardInterrupt:
+        pass
+
+
+def _memory_kb(pid: int) -> tuple:
+    """(current, peak) resident set size of one process, from /proc."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return fields.get("VmRSS", 0), fields.get("VmHWM", 0)
+
+
+def _process_tree(pid: int) -> list:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    return [pid] + [descendant for child in children for descendant in _process_tree(child)]
+
+
+async def _sample_rss(pid: int, peak: dict):
+    """Track the largest single process and the whole tree of the bot (Linux only)."""
+    while True:
+        memory = [_memory_kb(process) for process in _process_tree(pid)]
+        peak["tree"] = max(peak["tree"], sum(current for current, _ in memory))
+        peak["largest"] = max([peak["largest"]] + [high for _, high in memory])
+        await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+
+def write_keys(workdir: str, telegram_url: str, api_url: str, webhook_port: int, overrides: list):
+    test_file = os.path.join(workdir, "test_file.xlsx")
+    with open(test_file, "wb") as f:
+        f.write(meter_workbook(7))
+    lines = [KEYS_TEMPLATE.format(token=TOKEN, sad=SAD_PIC, haha=HAHA_PIC, test_file=test_file, tariffs=TARIFFS_PATH,
+                                  telegram_url=telegram_url, api_url=api_url)]
+    if webhook_port is not None:
+        lines.append(f'WEBHOOK_URL = "http://127.0.0.1:{webhook_port}"\nWEBHOOK_HOST = "127.0.0.1"\n'
+                     f'WEBHOOK_PORT = {webhook_port}\n')
+    lines.extend(f"{override}\n" for override in overrides)
+    with open(os.path.join(workdir, "keys.py"), "w") as f:
+        f.writelines(lines)
+
+
+async def _start_app(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None, handler_cancellation=True)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def run(args, concurrency: int) -> str:
+    telegram = FakeTelegram(args.tg_latency, args.tg_error_rate, args.tg_error_code,
+                            meter_workbook(args.days))
+    etf = FakeEtfApi(args.api_latency, args.api_error_rate, args.api_error_code, args.api_slow_rate,
+                     args.api_slow_latency, args.api_hang_rate)
+    telegram_port, api_port = free_port(), free_port()
+    webhook_port = free_port() if args.mode == "webhook" else None
+    runners = [await _start_app(telegram.app(), telegram_port), await _start_app(etf.app(), api_port)]
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    cwd = os.getcwd()
+    write_keys(workdir, f"http://127.0.0.1:{telegram_port}", f"http://127.0.0.1:{api_port}", webhook_port,
+               args.set)
+    # the bot imports keys.py and keeps users.db in the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(target=_run_bot, args=(args.bot, args.workers,
+                                                     logging.INFO if args.verbose else logging.WARNING))
+    process.start()
+    sys.path.remove(workdir)
+    peak_rss = {"largest": 0, "tree": 0}
+    sampler = asyncio.create_task(_sample_rss(process.pid, peak_rss))
+
+    webhook_url = f"http://127.0.0.1:{webhook_port}/webhook" if webhook_port else None
+    try:
+        async with Driver(telegram, args, webhook_url) as driver:
+            await asyncio.wait_for(telegram.ready.wait(), STOP_TIMEOUT)
+            await driver.warm_up(args.workers or 1)
+            api_calls_before = sum(etf.calls.values())
+            semaphore = asyncio.Semaphore(concurrency)
+            started_at = time.perf_counter()
+            await asyncio.gather(*(driver.journey(index, semaphore) for index in range(args.users)))
+            elapsed = time.perf_counter() - started_at
+            # let trailing calls such as deleteMessage finish before stopping the bot
+            await telegram.idle(QUIET_PERIOD + args.tg_latency * 2)
+    finally:
+        os.kill(process.pid, signal.SIGINT)
+        await asyncio.get_running_loop().run_in_executor(None, process.join, STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+        sampler.cancel()
+        for runner in runners:
+            await runner.cleanup()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report(args, concurrency, driver, telegram, etf, elapsed, sum(etf.calls.values()) - api_calls_before,
+                  peak_rss)
+
+
+def _latency_line(name: str, values: list) -> str:
+    return (f"  {name:<12} n={len(values):<6} p50={percentile(values, 50) * 1000:8.1f}ms "
+            f"p95={percentile(values, 95) * 1000:8.1f}ms p99={percentile(values, 99) * 1000:8.1f}ms")
+
+
+def report(args, concurrency: int, driver: Driver, telegram: FakeTelegram, etf: FakeEtfApi, elapsed: float,
+           api_calls: int, peak_rss: dict) -> str:
+    lines = [
+        f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} bot={args.bot} mode={args.mode} workers={args.workers} "
+        f"users={args.users} concurrency={concurrency} same_file={args.same_file} file={args.days} days",
+        f"   tg latency={args.tg_latency}s errors={args.tg_error_rate} ({args.tg_error_code}), "
+        f"api latency={args.api_latency}s errors={args.api_error_rate} ({args.api_error_code}) "
+        f"slow={args.api_slow_rate} ({args.api_slow_latency}s) hang={args.api_hang_rate}"
+        + (f", overrides: {'; '.join(args.set)}" if args.set else ""),
+        f"elapsed: {elapsed:.2f}s",
+        f"updates/s: {driver.updates_answered / elapsed:.1f} ({driver.updates_answered} answered)",
+        f"journeys/s: {driver.outcomes['ok'] / elapsed:.2f}",
+        "journeys: " + ", ".join(f"{name}={count}" for name, count in sorted(driver.outcomes.items())),
+        "latency:",
+        _latency_line("journey", driver.journey_latency),
+        *(_latency_line(name, values) for name, values in driver.step_latency.items()),
+        f"upstream calls: {api_calls} ({', '.join(f'{k}={v}' for k, v in sorted(etf.calls.items()))}), "
+        f"injected errors: {etf.errors}, peak in flight: {etf.peak_in_flight}",
+        f"bot api calls: {', '.join(f'{k}={v}' for k, v in sorted(telegram.calls.items()))}, "
+        f"injected errors: {telegram.errors}, new messages: peak {telegram.peak_send_rate()}/s over 1 s",
+        f"peak RSS: largest process {peak_rss['largest'] / 1024:.1f} MB, process tree {peak_rss['tree'] / 1024:.1f} MB",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load-test a bot against local fake servers.")
+    parser.add_argument("--bot", choices=sorted(JOURNEYS), default="main_nomanual")
+    parser.add_argument("--mode", default="polling",
+                        help="polling or webhook, comma-separated to compare them under the same load")
+    parser.add_argument("--workers", type=int, default=0, help="run through shard.py with N workers")
+    parser.add_argument("--users", type=int, default=200, help="journeys per run")
+    parser.add_argument("--concurrency", default="50", help="journeys at a time, comma-separated for several runs")
+    parser.add_argument("--think-time", type=float, default=0, help="pause between steps of a journey")
+    parser.add_argument("--step-timeout", type=float, default=10)
+    parser.add_argument("--tg-latency", type=float, default=0.02)
+    parser.add_argument("--tg-error-rate", type=float, default=0)
+    parser.add_argument("--tg-error-code", type=int, choices=(429, 500), default=429)
+    parser.add_argument("--api-latency", type=float, default=0.3)
+    parser.add_argument("--api-error-rate", type=float, default=0)
+    parser.add_argument("--api-error-code", type=int, choices=sorted(ERROR_RESPONSES), default=503)
+    parser.add_argument("--api-slow-rate", type=float, default=0, help="share of API calls taking --api-slow-latency")
+    parser.add_argument("--api-slow-latency", type=float, default=5)
+    parser.add_argument("--api-hang-rate", type=float, default=0, help="share of API calls never answered")
+    parser.add_argument("--days", type=int, default=365, help="days of hourly readings in the uploaded workbook")
+    parser.add_argument("--same-file", action="store_true", help="every user uploads the same file")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra keys.py line, e.g. --set JOB_WORKERS=16")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own log")
+    parser.add_argument("--parse", type=int, default=0, metavar="N",
+                        help="time workbook parsing N times per file instead of a load test")
+    parser.add_argument("--costs", type=int, default=0, metavar="N",
+                        help="time the local cost engine on N profiles instead of a load test")
+    parser.add_argument("--api", type=int, default=0, metavar="N",
+                        help="time N calls to the fake API with and without the pooled client instead of a load test")
+    parser.add_argument("--upload", type=int, default=0, metavar="MB",
+                        help="stream an MB-sized upload through validation and the API client, checking peak memory")
+    parser.add_argument("--memory-ceiling", type=float, default=16, metavar="MB",
+                        help="peak traced memory --upload allows for the streaming path")
+    parser.add_argument("--coalesce", type=int, default=0, metavar="N",
+                        help="send N identical API calls at once and count upstream hits instead of a load test")
+    parser.add_argument("--fsm", type=int, default=0, metavar="N",
+                        help="run N dialogs through the FSM storages and time state transitions instead of a load test")
+    parser.add_argument("--resilience", type=int, default=0, metavar="N",
+                        help="check retries, the circuit breaker and pile-up against a failing fake API, "
+                             "N calls at once, instead of a load test")
+    parser.add_argument("--starts", type=int, default=0, metavar="N",
+                        help="time N simultaneous /start registrations against users.db instead of a load test")
+    args = parser.parse_args()
+    args.modes = args.mode.split(",")
+    if not set(args.modes) <= {"polling", "webhook"}:
+        parser.error(f"unknown --mode {args.mode}, expected polling, webhook or both")
+    if args.workers and "webhook" in args.modes:
+        parser.error("shard.py only polls, --workers needs --mode polling")
+    return args
+
+
+def _time_parse(parse, data: bytes, rounds: int) -> tuple:
+    """Durations of ``rounds`` parses of ``data`` and the peak memory traced during one."""
+    durations, error = [], None
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        try:
+            parse(data)
+        except ValueError as e:
+            error = e
+        durations.append(time.perf_counter() - started_at)
+    tracemalloc.start()
+    try:
+        parse(data)
+    except ValueError:
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return durations, peak, error
+
+
+def _import_offline(name: str, overrides: list):
+    """Import a bot module in this process, with a throwaway keys.py pointing nowhere."""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    write_keys(workdir, "http://127.0.0.1:1", "http://127.0.0.1:1", None, overrides)
+    sys.path.insert(0, workdir)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(workdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_bench(args) -> str:
+    parse_workbook = _import_offline("workbook", args.set).parse_workbook
+    wide = meter_workbook(args.days)
+    files = {
+        "wide": wide,
+        "long": meter_workbook(args.days, "long"),
+        "not xlsx": os.urandom(len(wide)),
+        "truncated": wide[:len(wide) // 2],
+        "empty": meter_workbook(0),
+    }
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} parse_workbook, {args.days} days, "
+             f"{args.parse} rounds"]
+    for name, data in files.items():
+        durations, peak, error = _time_parse(parse_workbook, data, args.parse)
+        lines.append(f"  {name:<10} {len(data) / 1024:7.1f}KB p50={percentile(durations, 50) * 1000:8.2f}ms "
+                     f"p95={percentile(durations, 95) * 1000:8.2f}ms peak memory={peak / 1024 / 1024:6.1f}MB "
+                     + (f"rejected: {error}" if error else "ok"))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def costs_bench(args) -> str:
+    import numpy as np
+    costs = _import_offline("costs", args.set)
+    workbook = importlib.import_module("workbook")
+    engine = costs.CostEngine()
+    rng = np.random.default_rng(args.seed)
+    hours = args.days * 24
+    daily = 1 + 0.5 * np.sin(np.arange(hours) % 24 / 24 * 2 * np.pi - np.pi / 2)
+    values = (rng.uniform(10, 200, (args.costs, 1)) * daily * rng.uniform(0.8, 1.2, (args.costs, hours)))
+    values = values.astype(np.float32)
+    start = datetime.datetime.combine(WORKBOOK_START, datetime.time())
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} cost engine, {args.costs} profiles of {args.days} days"]
+    for voltage, transmission in (("CH1", False), ("CH1", True), ("HH", True)):
+        # the first call builds the weights for this period, voltage and contract
+        started_at = time.perf_counter()
+        engine.monthly_costs(values[0], start, voltage, transmission)
+        first = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        for row in values:
+            engine.costs(workbook.HourlyProfile(start, row), voltage, transmission, 700)
+        single = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        engine.monthly_costs(values, start, voltage, transmission)
+        batch = time.perf_counter() - started_at
+        lines.append(f"  {voltage:<4} transmission={transmission!s:<5} first call {first * 1000:6.1f}ms, "
+                     f"one by one {args.costs / single:8.0f} profiles/s ({single / args.costs * 1e6:6.1f}us each), "
+                     f"batch {args.costs / batch:8.0f} profiles/s")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _count_commits(conn: aiosqlite.Connection, commits: Counter):
+    commit = conn.commit
+
+    async def counted():
+        await commit()
+        commits["commits"] += 1
+    conn.commit = counted
+
+
+async def _start_per_connection(commits: Counter, user_id: int, username: str) -> bool:
+    async with aiosqlite.connect("users.db") as conn:
+        _count_commits(conn, commits)
+        async with conn.execute(SELECT_USER, (user_id,)) as cursor:
+            exists = await cursor.fetchone()
+        if exists:
+            await conn.execute(UPDATE_USER, (username, user_id))
+        else:
+            await conn.execute(INSERT_USER, (user_id, username))
+        await conn.commit()
+    return not exists
+
+
+async def _start_upsert(conn: aiosqlite.Connection, user_id: int, username: str) -> bool:
+    async with conn.execute(UPSERT_USER, (user_id, username)) as cursor:
+        row = await cursor.fetchone()
+    await conn.commit()
+    return row[0] == 1
+
+
+async def _start_write_behind(db, user_id: int, username: str) -> bool:
+    return db.register_user(user_id, username)
+
+
+async def _starts_round(start, users: list, settle=None) -> tuple:
+    """Latencies of ``users`` registering at the same moment, the wall time and the failures.
+
+    The wall time runs until ``settle`` returns, so it includes writing out what was left buffered.
+    """
+    async def one(user_id):
+        started_at = time.perf_counter()
+        await start(user_id, f"user{user_id}")
+        return time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(one(user_id) for user_id in users), return_exceptions=True)
+    if settle is not None:
+        await settle()
+    elapsed = time.perf_counter() - started_at
+    failures = Counter(type(result).__name__ for result in results if isinstance(result, BaseException))
+    return [result for result in results if not isinstance(result, BaseException)], elapsed, failures
+
+
+async def _starts_bench(args) -> str:
+    db = _import_offline("db", args.set)
+    users = random.sample(range(FIRST_CHAT_ID, FIRST_CHAT_ID * 2), args.starts)
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} /start registration, {args.starts} simultaneous users"]
+    cwd = os.getcwd()
+    for name in ("connection per call", "shared upsert", "write-behind"):
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        os.chdir(workdir)
+        try:
+            db._known_users.clear()
+            await db.init_db()
+            commits, settle = Counter(), None
+            _count_commits(db.get_db(), commits)
+            if name == "connection per call":
+                start = partial(_start_per_connection, commits)
+            elif name == "shared upsert":
+                start = partial(_start_upsert, db.get_db())
+            else:
+                start, settle = partial(_start_write_behind, db), db.flush_users
+            for round_name in ("new", "returning"):
+                commits.clear()
+                latencies, elapsed, failures = await _starts_round(start, users, settle)
+                lines.append(f"  {name:<20} {round_name:<9} {len(latencies) / elapsed:8.0f} starts/s "
+                             f"{commits['commits'] / elapsed:7.0f} commits/s "
+                             f"p50={percentile(latencies, 50) * 1000:8.1f}ms "
+                             f"p99={percentile(latencies, 99) * 1000:8.1f}ms"
+                             + "".join(f" {error}={count}" for error, count in failures.items()))
+            await db.close_db()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def starts_bench(args) -> str:
+    return asyncio.run(_starts_bench(args))
+
+
+async def _session_per_request(url: str, data: bytes, params: dict):
+    async with aiohttp.ClientSession() as session:
+        form = aiohttp.FormData()
+        form.add_field(name="payload", value=data, filename="bench.xlsx",
+                       content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        async with session.post(f"{url}/api/clients/cases", data=form, params=params,
+                                headers={"accept": "application/json"}) as response:
+            await response.text()
+
+
+async def _api_bench(args) -> str:
+    api = _import_offline("api", args.set)
+    concurrency = int(args.concurrency.split(",")[0])
+    etf = FakeEtfApi(args.api_latency, 0)
+    port = free_port()
+    runner = await _start_app(etf.app(), port)
+    url = f"http://127.0.0.1:{port}"
+    client = api.ApiClient(base_url=url)
+    await client.start()
+    data = meter_workbook(args.days)
+    params = {"is_transmission_included": "false", "max_power_capacity_kwt": "700", "voltage_category": "CH1"}
+    calls = {
+        "session per request": partial(_session_per_request, url, data, params),
+        "shared pool": partial(client.client_cases, data, "bench.xlsx", "CH1", False, 700),
+    }
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} /api/clients/cases, {args.api} calls, "
+             f"concurrency {concurrency}, api latency {args.api_latency}s"]
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        for name, call in calls.items():
+            etf.peers.clear()
+            latencies = []
+
+            async def one():
+                async with semaphore:
+                    started_at = time.perf_counter()
+                    await call()
+                    latencies.append(time.perf_counter() - started_at)
+
+            started_at = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(args.api)))
+            elapsed = time.perf_counter() - started_at
+            lines.append(f"  {name:<20} {args.api / elapsed:8.1f} calls/s "
+                         f"p50={percentile(latencies, 50) * 1000:8.2f}ms p95={percentile(latencies, 95) * 1000:8.2f}ms "
+                         f"p99={percentile(latencies, 99) * 1000:8.2f}ms connections={len(etf.peers)}")
+    finally:
+        await client.close()
+        await runner.cleanup()
+    lines.append("")
+    return "\n".join(lines)
+
+
+def api_bench(args) -> str:
+    return asyncio.run(_api_bench(args))
+
+
+async def _traced_peak(coro) -> int:
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    await coro
+    return tracemalloc.get_traced_memory()[1] - baseline
+
+
+async def _upload_bench(args) -> str:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    overrides = [f"WORKBOOK_MAX_BYTES = {args.upload + 1} * 1024 * 1024", "WORKBOOK_WORKERS = 0", *args.set]
+    api = _import_offline("api", overrides)
+    files = importlib.import_module("files")
+    workbook = importlib.import_module("workbook")
+    data = padded_workbook(args.days, args.upload * 1024 * 1024)
+    telegram, etf = FakeTelegram(0, 0, 429, data), FakeEtfApi(0, 0)
+    telegram_port, api_port = free_port(), free_port()
+    runners = [await _start_app(telegram.app(), telegram_port), await _start_app(etf.app(), api_port)]
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{telegram_port}")))
+    client = api.ApiClient(base_url=f"http://127.0.0.1:{api_port}")
+    await client.start()
+    reader = workbook.WorkbookReader(workers=0)
+    stream = partial(files.stream_telegram_file, bot, "upload")
+
+    async def buffered():
+        # what the bot did before streaming: download into memory, read it out, post the bytes
+        downloaded = await bot.download("upload")
+        await client.client_cases(downloaded.read(), "upload.xlsx", "CH1", False, 700)
+
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} {len(data) / 1024 / 1024:.1f}MB upload, "
+             f"memory ceiling {args.memory_ceiling}MB"]
+    tracemalloc.start()
+    try:
+        checks = {
+            "validation": (reader.profile("upload", stream), True),
+            "streamed upload": (client.client_cases(stream, "upload.xlsx", "CH1", False, 700), True),
+            "buffered upload": (buffered(), False),
+        }
+        for name, (coro, checked) in checks.items():
+            received = etf.bytes_received
+            started_at = time.perf_counter()
+            peak = await _traced_peak(coro) / 1024 / 1024
+            elapsed = time.perf_counter() - started_at
+            verdict = ("ok" if peak <= args.memory_ceiling else "FAILED: over the ceiling") if checked else "reference"
+            lines.append(f"  {name:<16} {elapsed * 1000:8.1f}ms peak memory={peak:6.1f}MB "
+                         f"sent upstream={(etf.bytes_received - received) / 1024 / 1024:5.1f}MB {verdict}")
+    finally:
+        tracemalloc.stop()
+        await client.close()
+        await bot.session.close()
+        for runner in runners:
+            await runner.cleanup()
+    lines.append("")
+    return "\n".join(lines)
+
+
+def upload_bench(args) -> str:
+    return asyncio.run(_upload_bench(args))
+
+
+async def _coalesce_bench(args) -> str:
+    api = _import_offline("api", args.set)
+    cache = importlib.import_module("cache")
+    etf = FakeEtfApi(args.api_latency, 0)
+    port = free_port()
+    runner = await _start_app(etf.app(), port)
+    client = api.ApiClient(base_url=f"http://127.0.0.1:{port}", cache=cache.ResultCache(persistent=False),
+                           retries=0, breaker_failures=args.coalesce + 1)
+    await client.start()
+    data = meter_workbook(args.days)
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} {args.coalesce} identical /api/clients/cases calls "
+             f"at once, api latency {args.api_latency}s"]
+    # error rate, upstream hits expected and the status every caller should get
+    rounds = (("backend failing", 1, 1, args.api_error_code), ("backend back", 0, 1, 200), ("cached", 0, 0, 200))
+    try:
+        for name, error_rate, expected_hits, expected_status in rounds:
+            etf.error_rate = error_rate
+            calls = etf.calls["clients-cases"]
+            started_at = time.perf_counter()
+            responses = await asyncio.gather(*(
+                client.client_cases(data, "bench.xlsx", "CH1", False, 700, content_key="tg:bench")
+                for _ in range(args.coalesce)
+            ))
+            elapsed = time.perf_counter() - started_at
+            hits = etf.calls["clients-cases"] - calls
+            statuses = Counter(response.status for response in responses)
+            ok = hits == expected_hits and statuses == Counter({expected_status: args.coalesce})
+            lines.append(f"  {name:<16} {elapsed * 1000:8.1f}ms upstream hits={hits} (expected {expected_hits}) "
+                         + " ".join(f"{status}={count}" for status, count in sorted(statuses.items()))
+                         + (" ok" if ok else " FAILED"))
+    finally:
+        await client.close()
+        await runner.cleanup()
+    lines.append("")
+    return "\n".join(lines)
+
+
+def coalesce_bench(args) -> str:
+    return asyncio.run(_coalesce_bench(args))
+
+
+async def _fsm_dialog(storage, chat_id: int):
+    """The states and data main_nomanual's Form goes through for one upload, as its handlers touch them."""
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    state = FSMContext(storage, StorageKey(bot_id=BOT_USER["id"], chat_id=chat_id, user_id=chat_id))
+    await state.set_state("Form:waiting_for_file")
+    await state.update_data(file_id=f"file-{chat_id}", file_unique_id=f"unique-{chat_id}", filename="bench.xlsx")
+    await state.set_state("Form:waiting_for_voltage_category")
+    await state.update_data(voltage_category="CH1")
+    await state.set_state("Form:waiting_for_contract_type")
+    await state.update_data(contract_type=True)
+    await state.set_state("Form:waiting_for_max_voltage")
+    await state.update_data(max_voltage=700)
+    await state.get_data()
+    await state.clear()
+
+
+# state transitions per dialog in _fsm_dialog, clear() included
+FSM_TRANSITIONS = 5
+
+
+async def _fsm_bench(args) -> str:
+    from aiogram.fsm.storage.memory import MemoryStorage
+    storage_module = _import_offline("storage", args.set)
+    db = importlib.import_module("db")
+    concurrency = int(args.concurrency.split(",")[0])
+    storages = {
+        "memory": MemoryStorage,
+        "sqlite": partial(storage_module.SQLiteStorage, cache=True),
+        "sqlite, no cache": partial(storage_module.SQLiteStorage, cache=False),
+    }
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} FSM storage, {args.fsm} dialogs, "
+             f"concurrency {concurrency}"]
+    cwd = os.getcwd()
+    for name, make_storage in storages.items():
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        os.chdir(workdir)
+        try:
+            await db.init_db()
+            storage = make_storage()
+            if hasattr(storage, "start"):
+                storage.start()
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies = []
+
+            async def dialog(chat_id):
+                async with semaphore:
+                    started_at = time.perf_counter()
+                    await _fsm_dialog(storage, chat_id)
+                    latencies.append(time.perf_counter() - started_at)
+
+            started_at = time.perf_counter()
+            await asyncio.gather(*(dialog(FIRST_CHAT_ID + index) for index in range(args.fsm)))
+            # the SQLite storage is timed until its last coalesced write is committed
+            await storage.close()
+            elapsed = time.perf_counter() - started_at
+            lines.append(f"  {name:<17} {args.fsm * FSM_TRANSITIONS / elapsed:9.0f} transitions/s "
+                         f"dialog p50={percentile(latencies, 50) * 1000:7.2f}ms "
+                         f"p99={percentile(latencies, 99) * 1000:7.2f}ms")
+        finally:
+            await db.close_db()
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def fsm_bench(args) -> str:
+    return asyncio.run(_fsm_bench(args))
+
+
+# client settings for --resilience, small so that the checks run in seconds
+RESILIENCE_CLIENT = {"retries": 2, "retry_base": 0.01, "retry_max": 0.05, "connect_timeout": 1, "read_timeout": 0.5,
+                     "timeout": 2, "pool_limit": 10, "breaker_failures": 5, "breaker_reset": 60}
+
+
+async def _timed_call(client, api) -> tuple:
+    """Duration of one client_cases call and its status, or the name of the error it raised."""
+    started_at = time.perf_counter()
+    try:
+        result = (await client.client_cases(b"PK", "bench.xlsx", "CH1", False, 700)).status
+    except api.ApiUnavailable:
+        result = "unavailable"
+    return time.perf_counter() - started_at, result
+
+
+async def _resilience_check(api, name: str, etf: FakeEtfApi, check) -> str:
+    port = free_port()
+    runner = await _start_app(etf.app(), port)
+    client = api.ApiClient(base_url=f"http://127.0.0.1:{port}", **RESILIENCE_CLIENT)
+    await client.start()
+    try:
+        detail, ok = await check(client, etf)
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return f"  {name:<26} {detail} " + ("ok" if ok else "FAILED")
+
+
+async def _resilience_bench(args) -> str:
+    api = _import_offline("api", args.set)
+    settings = RESILIENCE_CLIENT
+    attempts = settings["retries"] + 1
+
+    def hits(etf: FakeEtfApi) -> int:
+        return etf.calls["clients-cases"]
+
+    async def retried(client, etf):
+        elapsed, result = await _timed_call(client, api)
+        return f"{hits(etf)} attempts (expected {attempts}), {result} after {elapsed * 1000:.0f}ms", \
+            hits(etf) == attempts and result == args.api_error_code
+
+    async def not_retried(client, etf):
+        elapsed, result = await _timed_call(client, api)
+        return (f"{hits(etf)} attempt (expected 1), {result} after {elapsed * 1000:.0f}ms "
+                f"(read timeout {settings['read_timeout'] * 1000:.0f}ms)"), \
+            hits(etf) == 1 and result == "unavailable" and elapsed < settings["read_timeout"] + 0.25
+
+    async def breaker(client, etf):
+        for _ in range(settings["breaker_failures"]):
+            await _timed_call(client, api)
+        opened_after = hits(etf)
+        results = await asyncio.gather(*(_timed_call(client, api) for _ in range(args.resilience)))
+        latencies = [elapsed for elapsed, _ in results]
+        fast = Counter(result for _, result in results)
+        return (f"opened after {opened_after} attempts, then {args.resilience} calls: "
+                f"{hits(etf) - opened_after} upstream hits, {dict(fast)}, p99={percentile(latencies, 99) * 1000:.1f}ms"), \
+            (client.breaker.is_open and hits(etf) == opened_after == settings["breaker_failures"] * attempts
+             and fast == Counter({"unavailable": args.resilience}) and max(latencies) < 0.05)
+
+    async def pile_up(client, etf):
+        results = await asyncio.gather(*(_timed_call(client, api) for _ in range(args.resilience)))
+        latencies = [elapsed for elapsed, _ in results]
+        # the fake API's handlers end once the bot has dropped their connections
+        await asyncio.sleep(0.1)
+        return (f"{args.resilience} calls, peak in flight {etf.peak_in_flight} (pool {settings['pool_limit']}), "
+                f"{etf.in_flight} left, p50={percentile(latencies, 50) * 1000:.0f}ms "
+                f"p99={percentile(latencies, 99) * 1000:.0f}ms"), \
+            (etf.peak_in_flight <= settings["pool_limit"] and etf.in_flight == 0
+             and max(latencies) <= settings["timeout"] + 0.25)
+
+    lines = [f"== {datetime.datetime.now():%Y-%m-%d %H:%M:%S} API resilience against a failing fake API, "
+             f"{args.resilience} calls at once"]
+    for name, etf, check in (
+        (f"{args.api_error_code} retried", FakeEtfApi(0, 1, args.api_error_code), retried),
+        ("read timeout not retried", FakeEtfApi(0, 0, hang_rate=1), not_retried),
+        ("circuit breaker", FakeEtfApi(0, 1, args.api_error_code), breaker),
+        ("hanging API, no pile-up", FakeEtfApi(0, 0, hang_rate=1), pile_up),
+    ):
+        lines.append(await _resilience_check(api, name, etf, check))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def resilience_bench(args) -> str:
+    return asyncio.run(_resilience_bench(args))
+
+
+OFFLINE_BENCHES = {"parse": parse_bench, "costs": costs_bench, "starts": starts_bench, "api": api_bench,
+                   "upload": upload_bench, "coalesce": coalesce_bench, "fsm": fsm_bench,
+                   "resilience": resilience_bench}
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    offline = [bench for name, bench in OFFLINE_BENCHES.items() if getattr(args, name)]
+    if offline:
+        text = "\n".join(bench(args) for bench in offline)
+        print(text)
+        with open(OUTPUT_PATH, "a", encoding="utf-8") as f:
+            f.write(text + "\n")
+        if "FAILED" in text:
+            sys.exit(1)
+        return
+    for concurrency in (int(value) for value in args.concurrency.split(",")):
+        for args.mode in args.modes:
+            text = asyncio.run(run(args, concurrency))
+            print(text)
+            with open(OUTPUT_PATH, "a", encoding="utf-8") as f:
+                f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import db
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY
+from log import log_error
+from ratelimit import TokenBucket
+
+SAVE_BATCH_SIZE = 50
+SAVE_INTERVAL = 1.0
+
+
+class Broadcast:
+    """Send one text to every user under a global rate limit.
+
+    Delivery status is stored per ``broadcast_id``, so running the same
+    broadcast again only reaches users it has not got through to yet.
+    """
+
+    def __init__(self, bot: Bot, broadcast_id: str, text: str, rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.broadcast_id = broadcast_id
+        self.text = text
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.counts = {"sent": 0, "blocked": 0, "failed": 0}
+        self._results = []
+        self._saved_at = time.monotonic()
+
+    async def _send(self, user_id: int) -> str:
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=self.text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                if "chat not found" in e.message.lower():
+                    return "blocked"
+                log_error("broadcast send failed", e, user_id=user_id)
+                return "failed"
+            except Exception as e:
+                log_error("broadcast send failed", e, user_id=user_id)
+                return "failed"
+
+    async def _save(self, force: bool = False):
+        if not self._results:
+            return
+        if not force and len(self._results) < SAVE_BATCH_SIZE and time.monotonic() - self._saved_at < SAVE_INTERVAL:
+            return
+        results, self._results = self._results, []
+        self._saved_at = time.monotonic()
+        await db.save_deliveries(self.broadcast_id, results)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            status = await self._send(user_id)
+            self.counts[status] += 1
+            self._results.append((user_id, status, time.time()))
+            await self._save()
+
+    async def run(self) -> dict:
+        await db.flush_users()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            async for user_id in db.iter_broadcast_recipients(self.broadcast_id):
+                await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self._save(force=True)
+        return self.counts
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import db
+from config import CACHE_MAX_SIZE, CACHE_TTL, CACHE_PERSISTENT
+
+
+def make_key(*parts) -> str:
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResultCache:
+    """LRU cache of API results with a TTL and an optional SQLite tier.
+
+    Values must be JSON serializable when the persistent tier is enabled.
+    """
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: float = CACHE_TTL,
+                 persistent: bool = CACHE_PERSISTENT):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _remember(self, key: str, value, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        if self.persistent:
+            row = await db.get_cached_result(key, now)
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.persistent:
+            await db.set_cached_result(key, json.dumps(value, ensure_ascii=False), expires_at)
+
+    async def sweep(self) -> int:
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        if self.persistent:
+            await db.purge_cached_results(now)
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key.
+
+    Every waiter gets the result or the exception of the shared call, nothing is
+    remembered once it finishes.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
@@ -0,0 +1,107 @@
+import os
+
+import keys
+
+# Optional settings, override any of them in keys.py
+
+API_BASE_URL = getattr(keys, "API_BASE_URL", "https://etf-team.ru")
+API_POOL_LIMIT = getattr(keys, "API_POOL_LIMIT", 20)
+API_KEEPALIVE_TIMEOUT = getattr(keys, "API_KEEPALIVE_TIMEOUT", 30)
+API_DNS_CACHE_TTL = getattr(keys, "API_DNS_CACHE_TTL", 300)
+# API_TIMEOUT bounds a whole call including retries, the other two every single attempt
+API_TIMEOUT = getattr(keys, "API_TIMEOUT", 60)
+API_CONNECT_TIMEOUT = getattr(keys, "API_CONNECT_TIMEOUT", 5)
+API_READ_TIMEOUT = getattr(keys, "API_READ_TIMEOUT", 30)
+API_RETRIES = getattr(keys, "API_RETRIES", 2)
+API_RETRY_BASE = getattr(keys, "API_RETRY_BASE", 0.5)
+API_RETRY_MAX = getattr(keys, "API_RETRY_MAX", 5)
+# send a second copy of a call still running after the endpoint's p95 latency
+API_HEDGE = getattr(keys, "API_HEDGE", False)
+API_BREAKER_FAILURES = getattr(keys, "API_BREAKER_FAILURES", 5)
+API_BREAKER_RESET = getattr(keys, "API_BREAKER_RESET", 30)
+
+# Bot API server base URL, e.g. a local telegram-bot-api; None means api.telegram.org
+TELEGRAM_API_URL = getattr(keys, "TELEGRAM_API_URL", None)
+
+DOWNLOAD_CHUNK_SIZE = getattr(keys, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+DOWNLOAD_TIMEOUT = getattr(keys, "DOWNLOAD_TIMEOUT", 120)
+
+STATE_TTL = getattr(keys, "STATE_TTL", 24 * 60 * 60)
+STATE_SWEEP_INTERVAL = getattr(keys, "STATE_SWEEP_INTERVAL", 10 * 60)
+
+CACHE_MAX_SIZE = getattr(keys, "CACHE_MAX_SIZE", 1024)
+CACHE_TTL = getattr(keys, "CACHE_TTL", 6 * 60 * 60)
+CACHE_PERSISTENT = getattr(keys, "CACHE_PERSISTENT", False)
+
+# uploaded workbooks are checked before anything is sent upstream; WORKBOOK_WORKERS = 0 parses in a thread
+# uploads are spooled to disk for that, so the size caps bound disk use and parse time rather than memory;
+# api.telegram.org gives bots files of up to 20 MB, a local Bot API server larger ones
+WORKBOOK_MAX_BYTES = getattr(keys, "WORKBOOK_MAX_BYTES", (20 if TELEGRAM_API_URL is None else 100) * 1024 * 1024)
+WORKBOOK_MAX_UNPACKED = getattr(keys, "WORKBOOK_MAX_UNPACKED", 512 * 1024 * 1024)
+WORKBOOK_MAX_SHEETS = getattr(keys, "WORKBOOK_MAX_SHEETS", 5)
+WORKBOOK_MAX_ROWS = getattr(keys, "WORKBOOK_MAX_ROWS", 20000)
+WORKBOOK_WORKERS = getattr(keys, "WORKBOOK_WORKERS", 1)
+WORKBOOK_CACHE_SIZE = getattr(keys, "WORKBOOK_CACHE_SIZE", 256)
+# upload a small normalized workbook rebuilt from the hourly profile instead of the user's file
+WORKBOOK_SEND_COMPACT = getattr(keys, "WORKBOOK_SEND_COMPACT", False)
+
+JOB_WORKERS = getattr(keys, "JOB_WORKERS", 8)
+JOB_QUEUE_SIZE = getattr(keys, "JOB_QUEUE_SIZE", 100)
+JOB_POSITION_INTERVAL = getattr(keys, "JOB_POSITION_INTERVAL", 2)
+
+# pictures and the demo workbook are uploaded from STATIC_DIR once and then sent by file_id;
+# the *_FILE_ID values are only used when a file is missing there
+STATIC_DIR = getattr(keys, "STATIC_DIR", "static")
+TEST_FILE_PATH = getattr(keys, "TEST_FILE_PATH", os.path.join(STATIC_DIR, "test_file.xlsx"))
+HELLO_PIC_FILE_ID = getattr(keys, "HELLO_PIC_FILE_ID", None)
+SAD_PIC_FILE_ID = getattr(keys, "SAD_PIC_FILE_ID", None)
+HA_PIC_FILE_ID = getattr(keys, "HA_PIC_FILE_ID", None)
+HAHA_PIC_FILE_ID = getattr(keys, "HAHA_PIC_FILE_ID", None)
+
+# price categories can also be computed locally from the tariff tables in TARIFFS_PATH:
+# "fallback" asks the backend and fills the categories it does not return or answers alone when it is down,
+# "local" answers without the backend, "off" shows only what the backend returns.
+# static/tariffs.json holds example values: keep "off" until the region's real tariffs are in place
+TARIFFS_PATH = getattr(keys, "TARIFFS_PATH", os.path.join(STATIC_DIR, "tariffs.json"))
+COST_ENGINE = getattr(keys, "COST_ENGINE", "off")
+
+BROADCAST_RATE = getattr(keys, "BROADCAST_RATE", 28)
+BROADCAST_CONCURRENCY = getattr(keys, "BROADCAST_CONCURRENCY", 10)
+
+REMINDER_CRON = getattr(keys, "REMINDER_CRON", "0 10 15 * *")
+CACHE_SWEEP_CRON = getattr(keys, "CACHE_SWEEP_CRON", "*/30 * * * *")
+
+# pacing of all outgoing Bot API calls: messages per second overall and per chat, bursts of SEND_CHAT_BURST;
+# SEND_RATE is the whole bot's and shard.py splits it between its workers, but separate webhook instances
+# do not know about each other: give each one SEND_RATE divided by their number in its keys.py
+SEND_RATE = getattr(keys, "SEND_RATE", 28)
+SEND_CHAT_RATE = getattr(keys, "SEND_CHAT_RATE", 1)
+SEND_GROUP_RATE = getattr(keys, "SEND_GROUP_RATE", 20 / 60)
+SEND_CHAT_BURST = getattr(keys, "SEND_CHAT_BURST", 5)
+SEND_MAX_RETRIES = getattr(keys, "SEND_MAX_RETRIES", 3)
+
+# webhook mode is used instead of polling when WEBHOOK_URL is set
+WEBHOOK_URL = getattr(keys, "WEBHOOK_URL", None)
+WEBHOOK_PATH = getattr(keys, "WEBHOOK_PATH", "/webhook")
+# checked on every update; None makes a new random secret at each start, which only works with one
+# instance, as every instance registers the webhook with its own
+WEBHOOK_SECRET = getattr(keys, "WEBHOOK_SECRET", None)
+WEBHOOK_HOST = getattr(keys, "WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = getattr(keys, "WEBHOOK_PORT", 8080)
+WEBHOOK_CONCURRENCY = getattr(keys, "WEBHOOK_CONCURRENCY", 64)
+WEBHOOK_MAX_PENDING = getattr(keys, "WEBHOOK_MAX_PENDING", 1000)
+WEBHOOK_DRAIN_TIMEOUT = getattr(keys, "WEBHOOK_DRAIN_TIMEOUT", 30)
+
+FSM_FLUSH_INTERVAL = getattr(keys, "FSM_FLUSH_INTERVAL", 0.5)
+FSM_CACHE_SIZE = getattr(keys, "FSM_CACHE_SIZE", 10000)
+# the cache and the coalesced writes need every chat to stay with one process: true for polling, which
+# only one instance can do, and for its shards; webhook instances behind a load balancer read and write
+# the table on every access unless FSM_CACHE = True says the balancer keeps chats on one instance
+FSM_CACHE = getattr(keys, "FSM_CACHE", WEBHOOK_URL is None)
+
+SHARD_WORKERS = getattr(keys, "SHARD_WORKERS", os.cpu_count() or 2)
+SHARD_CONCURRENCY = getattr(keys, "SHARD_CONCURRENCY", 32)
+
+# set METRICS_PORT to None to disable the Prometheus endpoint
+METRICS_HOST = getattr(keys, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(keys, "METRICS_PORT", 9100)
@@ -0,0 +1,184 @@
+import datetime
+import json
+import os
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+
+from config import TARIFFS_PATH
+from workbook import HourlyProfile
+
+CATEGORIES = (1, 2, 3, 4, 5, 6)
+# voltage keyboard callback data -> key in the tariff tables
+VOLTAGES = {"BH": "ВН", "CH1": "СН1", "CH11": "СН11", "HH": "НН"}
+
+
+class CategoryCost(NamedTuple):
+    category: int
+    total_cost: float  # rubles per month
+    applicable: bool
+    # kW the maximum power has to be lowered by for the category to apply
+    recommendation: int
+
+
+def _hour_mask(months: list) -> np.ndarray:
+    if len(months) != 12:
+        raise ValueError("peak hours are needed for each of 12 months")
+    mask = np.zeros((12, 24), dtype=bool)
+    for month, hours in enumerate(months):
+        mask[month, hours] = True
+    return mask
+
+
+class Tariffs:
+    """Tariff tables of a region, read from JSON (see static/tariffs.json), in rubles without VAT.
+
+    Per-kWh prices of categories 1 and 2 and the hourly energy prices of 3-6
+    already include the supplier's markup and infrastructure payments; the
+    transmission part is added separately when the contract includes it.
+    """
+
+    def __init__(self, raw: dict):
+        self.cat1_max_power = int(raw["cat1_max_power_kw"])
+        self.cat1_price = float(raw["cat1_price"])
+        self.zone_price = np.full(24, np.nan)
+        for zone in raw["cat2_zones"]:
+            self.zone_price[zone["hours"]] = zone["price"]
+        if np.isnan(self.zone_price).any():
+            raise ValueError("cat2_zones must cover all 24 hours")
+        # energy price of categories 3 and 4 by month and hour of the day
+        self.energy_price = np.outer(raw["energy_price"], raw["energy_shape"])
+        if self.energy_price.shape != (12, 24):
+            raise ValueError("energy_price needs 12 months and energy_shape 24 hours")
+        self.plan_price_factor = float(raw["plan_price_factor"])
+        # categories 5 and 6 pay for the share of consumption that deviates from the planned schedule
+        self.deviation_cost = float(raw["deviation_price"]) * float(raw["deviation_share"])
+        self.capacity_price = np.asarray(raw["capacity_price"], dtype=np.float64)
+        if self.capacity_price.shape != (12,):
+            raise ValueError("capacity_price needs 12 months")
+        self.system_peak = _hour_mask(raw["system_peak_hours"])
+        self.network_peak = _hour_mask(raw["network_peak_hours"])
+        self.transmission_single = raw["transmission_single"]
+        self.transmission_capacity = raw["transmission_capacity"]
+        self.transmission_energy = raw["transmission_energy"]
+        for voltage in VOLTAGES.values():
+            for table in (self.transmission_single, self.transmission_capacity, self.transmission_energy):
+                if voltage not in table:
+                    raise ValueError(f"no transmission tariff for {voltage}")
+        self.holidays = np.array([int(month) * 100 + int(day)
+                                  for month, day in (holiday.split("-") for holiday in raw.get("holidays", ()))])
+
+
+@lru_cache(maxsize=4)
+def _load(path: str, mtime_ns: int, size: int) -> Tariffs:
+    with open(path, encoding="utf-8") as f:
+        return Tariffs(json.load(f))
+
+
+class _Weights(NamedTuple):
+    # monthly cost of every category is ``values @ linear`` plus, for categories 4 and 6,
+    # ``values[..., peak_hours].max(-1) @ peak_days``: the average over working days of
+    # the day's highest hour in the network's peak hours
+    linear: np.ndarray
+    peak_hours: np.ndarray
+    peak_days: np.ndarray
+
+
+@lru_cache(maxsize=64)
+def _weights(tariffs: Tariffs, start: datetime.datetime, hours: int, voltage: str,
+             transmission_included: bool) -> _Weights:
+    stamps = np.datetime64(start.replace(minute=0, second=0, microsecond=0), "h") + np.arange(hours)
+    days = stamps.astype("datetime64[D]")
+    months = stamps.astype("datetime64[M]")
+    hour = (stamps - days).astype(np.int64)
+    month_of_year = months.astype(np.int64) % 12
+    month_day = (month_of_year + 1) * 100 + (days - months).astype(np.int64) + 1
+    # 1970-01-01 was a Thursday
+    workday = ((days.astype(np.int64) + 3) % 7 < 5) & ~np.isin(month_day, tariffs.holidays)
+    month_index = np.unique(months, return_inverse=True)[1].reshape(-1)
+    month_start = np.unique(months)
+    month_hours = ((month_start + 1).astype("datetime64[h]") - month_start.astype("datetime64[h]")).astype(np.int64)
+    # a month counts by the share of its hours in the profile, so partly covered months do not skew the average
+    coverage = np.bincount(month_index) / month_hours
+    months_covered = coverage.sum()
+
+    single = tariffs.transmission_single[voltage] if transmission_included else 0.0
+    two_rate = tariffs.transmission_energy[voltage] if transmission_included else 0.0
+    energy = tariffs.energy_price[month_of_year, hour]
+    planned = energy * tariffs.plan_price_factor + tariffs.deviation_cost
+    linear = np.stack([
+        np.full(hours, tariffs.cat1_price + single),
+        tariffs.zone_price[hour] + single,
+        energy + single,
+        energy + two_rate,
+        planned + single,
+        planned + two_rate,
+    ], axis=1) / months_covered
+
+    # generation capacity: the average consumption in the system's peak hours of working days
+    system_peak = workday & tariffs.system_peak[month_of_year, hour]
+    peak_count = np.bincount(month_index, weights=system_peak, minlength=len(month_start))
+    per_month = np.divide(coverage, peak_count, out=np.zeros_like(coverage), where=peak_count > 0)
+    capacity = system_peak * tariffs.capacity_price[month_of_year] * per_month[month_index] / months_covered
+    linear[:, 2:] += capacity[:, None]
+
+    # network capacity: the average of daily maxima in the network's peak hours of working days
+    network_peak = np.flatnonzero(workday & tariffs.network_peak[month_of_year, hour])
+    if not transmission_included or not len(network_peak):
+        return _Weights(linear, np.zeros((0, 1), dtype=np.int64), np.zeros(0))
+    day_of_hour = days[network_peak]
+    peak_days, first, width = np.unique(day_of_hour, return_index=True, return_counts=True)
+    # pad every day to the longest window by repeating its first hour, which leaves the maximum as is
+    peak_hours = np.repeat(network_peak[first][:, None], width.max(), axis=1)
+    column = np.arange(len(network_peak)) - np.repeat(first, width)
+    peak_hours[np.repeat(np.arange(len(peak_days)), width), column] = network_peak
+    day_month = month_index[network_peak[first]]
+    days_in_month = np.bincount(day_month, minlength=len(month_start))
+    day_weights = tariffs.transmission_capacity[voltage] * coverage[day_month] / days_in_month[day_month] / months_covered
+    return _Weights(linear, peak_hours, day_weights)
+
+
+class CostEngine:
+    """Monthly cost of price categories 1-6 for an hourly profile, computed locally.
+
+    The tariff file is re-read when it changes on disk. Weights for a given
+    period, voltage and contract are cached, so a profile costs a matrix
+    product and a gather over the network's peak hours.
+    """
+
+    def __init__(self, path: str = TARIFFS_PATH):
+        self.path = path
+
+    def tariffs(self) -> Tariffs:
+        stat = os.stat(self.path)
+        return _load(self.path, stat.st_mtime_ns, stat.st_size)
+
+    def monthly_costs(self, values: np.ndarray, start: datetime.datetime, voltage: str,
+                      transmission_included: bool) -> np.ndarray:
+        """Costs of categories 1-6 for ``values`` of shape (hours,) or (profiles, hours) starting at ``start``."""
+        values = np.asarray(values, dtype=np.float64)
+        missing = np.isnan(values)
+        if missing.any():
+            # a missing hour is taken as the profile's average hour
+            values = np.where(missing, np.nanmean(values, axis=-1, keepdims=True), values)
+        weights = _weights(self.tariffs(), start, values.shape[-1], VOLTAGES.get(voltage, voltage),
+                           transmission_included)
+        costs = values @ weights.linear
+        if len(weights.peak_days):
+            network = values[..., weights.peak_hours].max(axis=-1) @ weights.peak_days
+            costs[..., 3] += network
+            costs[..., 5] += network
+        return costs
+
+    def costs(self, profile: HourlyProfile, voltage: str, transmission_included: bool,
+              max_power: int) -> dict:
+        """Category number -> CategoryCost for ``profile``; ``voltage`` as in VOLTAGES."""
+        tariffs = self.tariffs()
+        values = np.frombuffer(profile.values, dtype=np.float32)
+        monthly = self.monthly_costs(values, profile.start, voltage, transmission_included)
+        result = {}
+        for category, cost in zip(CATEGORIES, monthly.tolist()):
+            recommendation = max(0, max_power - tariffs.cat1_max_power + 1) if category == 1 else 0
+            result[category] = CategoryCost(category, cost, recommendation == 0, recommendation)
+        return result
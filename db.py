@@ -1,32 +1,306 @@
+import asyncio
+import json
+import time
+
 import aiosqlite
 
+from log import log_error
+from metrics import timed
+
+DB_PATH = "users.db"
+
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
+
+# the whole batch is one statement, [[user_id, username, starts], ...] as JSON: SQLite undoes a
+# failed statement by itself, so a failure leaves nothing half-written and needs no rollback,
+# which on the shared connection would also drop other coroutines' uncommitted writes
+UPSERT_USERS_BATCH = """
+    INSERT INTO users (user_id, username, strt, starts)
+    SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), 1, json_extract(value, '$[2]')
+    FROM json_each(?) WHERE true
+    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, starts = starts + excluded.starts
+"""
+
+_db = None
+
+# write-behind state: ids already in the table (or queued for it) and the
+# registrations that have not been committed yet, user_id -> (username, starts)
+_known_users = set()
+_pending = {}
+_flush_wakeup = None
+_flush_task = None
+_flush_stopping = False
+
+async def connect(path: str = DB_PATH) -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        _db = await aiosqlite.connect(path)
+        for pragma in PRAGMAS:
+            await _db.execute(pragma)
+    return _db
+
+def get_db() -> aiosqlite.Connection:
+    if _db is None:
+        raise RuntimeError("database is not connected, call init_db() first")
+    return _db
+
+async def close_db():
+    global _db
+    await stop_user_writer()
+    if _db is not None:
+        await _db.close()
+        _db = None
+
 async def init_db():
-    async with aiosqlite.connect("users.db") as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                strt Boolean
-            )
-        """)
-        await db.commit()
-
-async def add_user(user_id: int, username: str) -> bool:
-    async with aiosqlite.connect("users.db") as db:
-
-        async with db.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            exists = await cursor.fetchone()
-        if exists:
-            await db.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
-            await db.commit()
-            return False
-        else:
-            await db.execute("INSERT INTO users (user_id, username, strt) VALUES (?, ?, ?)", (user_id, username, True))
-            await db.commit()
-            return True
-
-async def get_all_users():
-    async with aiosqlite.connect("users.db") as db:
-        async with db.execute("SELECT user_id FROM users") as cursor:
+    db = await connect()
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            strt Boolean,
+            starts INTEGER NOT NULL DEFAULT 1,
+            blocked INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    async with db.execute("PRAGMA table_info(users)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if "starts" not in columns:
+        await db.execute("ALTER TABLE users ADD COLUMN starts INTEGER NOT NULL DEFAULT 1")
+    if "blocked" not in columns:
+        await db.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name TEXT PRIMARY KEY,
+            last_run TEXT NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS fsm_states_updated_at ON fsm_states (updated_at)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS result_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS assets (
+            bot_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (bot_id, name)
+        )
+    """)
+    await db.commit()
+    await load_known_users()
+    start_user_writer()
+
+@timed("sqlite")
+async def load_known_users():
+    async with get_db().execute("SELECT user_id FROM users") as cursor:
+        async for row in cursor:
+            _known_users.add(row[0])
+
+def register_user(user_id: int, username: str) -> bool:
+    """Queue a /start registration and tell whether the user is new.
+
+    Only the in-memory set is consulted, the row itself is written by the
+    background writer together with the rest of the batch.
+    """
+    is_new = user_id not in _known_users
+    _known_users.add(user_id)
+    _, starts = _pending.get(user_id, (None, 0))
+    _pending[user_id] = (username, starts + 1)
+    if len(_pending) >= FLUSH_BATCH_SIZE and _flush_wakeup is not None:
+        _flush_wakeup.set()
+    return is_new
+
+@timed("sqlite")
+async def flush_users():
+    global _pending
+    if not _pending:
+        return
+    batch, _pending = _pending, {}
+    db = get_db()
+    rows = json.dumps([[user_id, username, starts] for user_id, (username, starts) in batch.items()])
+    try:
+        await db.execute(UPSERT_USERS_BATCH, (rows,))
+    except Exception:
+        for user_id, (username, starts) in _pending.items():
+            _, queued = batch.get(user_id, (None, 0))
+            batch[user_id] = (username, queued + starts)
+        _pending = batch
+        raise
+    # a failed commit leaves the rows in the open transaction for the next commit, so they are not queued again
+    await db.commit()
+
+async def _flush_loop():
+    while not _flush_stopping:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        try:
+            await flush_users()
+        except Exception as e:
+            log_error("users flush failed", e)
+
+def start_user_writer():
+    global _flush_wakeup, _flush_task, _flush_stopping
+    if _flush_task is None:
+        _flush_stopping = False
+        _flush_wakeup = asyncio.Event()
+        _flush_task = asyncio.create_task(_flush_loop())
+
+async def stop_user_writer():
+    """Stop the writer after the flush it is running, if any, and write what is still pending.
+
+    The loop is not cancelled: a cancel inside a flush would lose the batch
+    it has already taken out of ``_pending``.
+    """
+    global _flush_task, _flush_stopping
+    if _flush_task is not None:
+        _flush_stopping = True
+        _flush_wakeup.set()
+        await _flush_task
+        _flush_task = None
+    if _db is not None:
+        await flush_users()
+
+async def iter_broadcast_recipients(broadcast_id: str, batch_size: int = 500):
+    """Yield ids of users still waiting for ``broadcast_id``, page by page.
+
+    Users who blocked the bot or already got (or refused) this broadcast are
+    skipped, so an interrupted broadcast resumes where it stopped.
+    """
+    last_id = None
+    while True:
+        async with get_db().execute("""
+            SELECT user_id FROM users
+            WHERE blocked = 0 AND (? IS NULL OR user_id > ?)
+              AND user_id NOT IN (
+                  SELECT user_id FROM broadcast_deliveries
+                  WHERE broadcast_id = ? AND status IN ('sent', 'blocked')
+              )
+            ORDER BY user_id LIMIT ?
+        """, (last_id, last_id, broadcast_id, batch_size)) as cursor:
             rows = await cursor.fetchall()
-            return [row[0] for row in rows]
\ No newline at end of file
+        if not rows:
+            return
+        for row in rows:
+            yield row[0]
+        last_id = rows[-1][0]
+
+@timed("sqlite")
+async def save_deliveries(broadcast_id: str, deliveries):
+    """Store (user_id, status, updated_at) rows and mark blocked users."""
+    db = get_db()
+    await db.executemany(
+        "INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, user_id, status, updated_at) VALUES (?, ?, ?, ?)",
+        [(broadcast_id, user_id, status, updated_at) for user_id, status, updated_at in deliveries],
+    )
+    await db.executemany(
+        "UPDATE users SET blocked = 1 WHERE user_id = ?",
+        [(user_id,) for user_id, status, _ in deliveries if status == "blocked"],
+    )
+    await db.commit()
+
+@timed("sqlite")
+async def get_job_last_run(name: str):
+    async with get_db().execute("SELECT last_run FROM scheduled_jobs WHERE name = ?", (name,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+@timed("sqlite")
+async def set_job_last_run(name: str, last_run: str):
+    db = get_db()
+    await db.execute("INSERT OR REPLACE INTO scheduled_jobs (name, last_run) VALUES (?, ?)", (name, last_run))
+    await db.commit()
+
+@timed("sqlite")
+async def get_fsm_record(key: str):
+    async with get_db().execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)) as cursor:
+        return await cursor.fetchone()
+
+@timed("sqlite")
+async def save_fsm_records(records, deleted):
+    """Upsert (key, state, data, updated_at) rows and drop ``deleted`` keys in one transaction."""
+    db = get_db()
+    await db.executemany(
+        "INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)", records
+    )
+    await db.executemany("DELETE FROM fsm_states WHERE key = ?", [(key,) for key in deleted])
+    await db.commit()
+
+@timed("sqlite")
+async def purge_fsm_records(updated_before: float) -> int:
+    db = get_db()
+    cursor = await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (updated_before,))
+    await db.commit()
+    return cursor.rowcount
+
+@timed("sqlite")
+async def get_cached_result(key: str, now: float):
+    async with get_db().execute(
+        "SELECT value, expires_at FROM result_cache WHERE key = ? AND expires_at > ?", (key, now)
+    ) as cursor:
+        return await cursor.fetchone()
+
+@timed("sqlite")
+async def set_cached_result(key: str, value: str, expires_at: float):
+    db = get_db()
+    await db.execute(
+        "INSERT OR REPLACE INTO result_cache (key, value, expires_at) VALUES (?, ?, ?)",
+        (key, value, expires_at),
+    )
+    await db.commit()
+
+@timed("sqlite")
+async def purge_cached_results(now: float) -> int:
+    db = get_db()
+    cursor = await db.execute("DELETE FROM result_cache WHERE expires_at <= ?", (now,))
+    await db.commit()
+    return cursor.rowcount
+
+@timed("sqlite")
+async def get_asset(bot_id: int, name: str):
+    async with get_db().execute("SELECT sha256, file_id FROM assets WHERE bot_id = ? AND name = ?",
+                                (bot_id, name)) as cursor:
+        return await cursor.fetchone()
+
+@timed("sqlite")
+async def set_asset(bot_id: int, name: str, sha256: str, file_id: str):
+    db = get_db()
+    await db.execute(
+        "INSERT OR REPLACE INTO assets (bot_id, name, sha256, file_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (bot_id, name, sha256, file_id, time.time()),
+    )
+    await db.commit()
@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from typing import AsyncIterator
+
+from aiogram import Bot
+
+from config import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
+from metrics import span
+
+
+async def stream_telegram_file(bot: Bot, file_id: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                               timeout: int = DOWNLOAD_TIMEOUT) -> AsyncIterator[bytes]:
+    """Yield a Telegram file chunk by chunk without buffering it as a whole.
+
+    The download is recorded as the ``telegram_download`` stage; when the
+    chunks are piped into an upload it overlaps with the upstream call.
+    """
+    with span("telegram_download"):
+        file = await bot.get_file(file_id)
+        url = bot.session.api.file_url(bot.token, file.file_path)
+        async for chunk in bot.session.stream_content(url=url, timeout=timeout, chunk_size=chunk_size,
+                                                      raise_for_status=True):
+            yield chunk
+
+
+async def stream_local_file(path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def open_file_data(bot: Bot, data: dict) -> AsyncIterator[bytes]:
+    """Resolve the file reference kept in FSM data into a lazy chunk stream."""
+    if data.get("file_id"):
+        return stream_telegram_file(bot, data["file_id"])
+    return stream_local_file(data["file_path"])
+
+
+async def spool(file_data) -> str:
+    """Write a chunk stream (or a callable opening one) to a temporary file and return its path.
+
+    Only one chunk is in memory at a time, whatever the file's size; the
+    caller removes the file.
+    """
+    if callable(file_data):
+        file_data = file_data()
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in file_data:
+                await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+@lru_cache(maxsize=32)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_key(file_unique_id: str = None, file_path: str = None) -> str:
+    """Identify the contents of an uploaded or local file for result caching.
+
+    Telegram's file_unique_id already names the contents of an upload, local
+    files are hashed (once per modification).
+    """
+    if file_unique_id:
+        return f"tg:{file_unique_id}"
+    stat = os.stat(file_path)
+    return f"sha256:{_file_digest(file_path, stat.st_mtime_ns, stat.st_size)}"
@@ -0,0 +1,157 @@
+import asyncio
+import time
+from collections import deque
+
+from config import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_POSITION_INTERVAL
+from metrics import counter, gauge, histogram
+
+JOB_WAIT_SECONDS = histogram("bot_job_wait_seconds", "Time a calculation job waited in the queue")
+JOB_SERVICE_SECONDS = histogram("bot_job_service_seconds", "Time a worker spent on a calculation job")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobAlreadyActive(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id: int, func, on_position=None):
+        self.user_id = user_id
+        self.func = func
+        self.on_position = on_position
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.reported_position = None
+
+
+class JobQueue:
+    """Bounded FIFO of calculation jobs served by a fixed pool of workers.
+
+    A user can have one job queued or running at a time. For jobs that have to
+    wait, ``on_position`` is awaited every ``position_interval`` seconds with the
+    1-based place in the queue when it has changed, and with 0 once a worker
+    picks the job up.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_size: int = JOB_QUEUE_SIZE,
+                 position_interval: float = JOB_POSITION_INTERVAL):
+        self.workers = workers
+        self.max_size = max_size
+        self.position_interval = position_interval
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=1000)
+        self.service_times = deque(maxlen=1000)
+        self._waiting = deque()
+        self._active_users = set()
+        self._running = 0
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiting)
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        gauge("bot_job_queue_depth", "Calculation jobs waiting for a worker", lambda: self.depth)
+        gauge("bot_job_running", "Calculation jobs being processed", lambda: self._running)
+        counter("bot_job_rejected_total", "Calculation jobs refused by the queue", lambda: self.rejected)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._report_positions()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._waiting:
+            job = self._waiting.popleft()
+            if not job.future.done():
+                job.future.cancel()
+        self._active_users.clear()
+
+    async def submit(self, user_id: int, func, on_position=None):
+        """Queue ``func`` (a coroutine function) for ``user_id`` and wait for its result."""
+        if user_id in self._active_users:
+            self.rejected += 1
+            raise JobAlreadyActive(user_id)
+        if len(self._waiting) >= self.max_size:
+            self.rejected += 1
+            raise QueueFull(len(self._waiting))
+        job = Job(user_id, func, on_position)
+        self._active_users.add(user_id)
+        self._waiting.append(job)
+        self._queue.put_nowait(job)
+        return await job.future
+
+    async def _notify(self, job: Job, position: int):
+        if job.on_position is None or job.reported_position == position:
+            return
+        job.reported_position = position
+        try:
+            await job.on_position(position)
+        except Exception:
+            pass
+
+    async def _report_positions(self):
+        while True:
+            await asyncio.sleep(self.position_interval)
+            for position, job in enumerate(list(self._waiting), start=1):
+                await self._notify(job, position)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            self._waiting.remove(job)
+            if job.future.done():
+                self._active_users.discard(job.user_id)
+                continue
+            started_at = time.monotonic()
+            self.wait_times.append(started_at - job.enqueued_at)
+            JOB_WAIT_SECONDS.observe(started_at - job.enqueued_at)
+            self._running += 1
+            if job.reported_position is not None:
+                asyncio.create_task(self._notify(job, 0))
+            try:
+                result = await job.func()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._running -= 1
+                self._active_users.discard(job.user_id)
+                self.service_times.append(time.monotonic() - started_at)
+                JOB_SERVICE_SECONDS.observe(time.monotonic() - started_at)
+                self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._waiting),
+            "running": self._running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait": sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0,
+            "avg_service": sum(self.service_times) / len(self.service_times) if self.service_times else 0.0,
+        }
+
+
+def edit_position(message, text: str):
+    """Build an ``on_position`` callback that shows the queue place under ``text``."""
+    async def report(position: int):
+        if position:
+            await message.edit_text(f"{text}\n\nВаше место в очереди: {position}")
+        else:
+            await message.edit_text(text)
+    return report
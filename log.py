@@ -0,0 +1,41 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+_queue = queue.SimpleQueue()
+
+logger = logging.getLogger("bot")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(_queue))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 3), "level": record.levelname.lower(), "event": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _start_listener() -> logging.handlers.QueueListener:
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# handlers only put records on the queue, a background thread writes them out
+_listener = _start_listener()
+
+
+def log(event: str, level: int = logging.INFO, **fields):
+    """Log one structured line: ``event`` plus arbitrary key/value ``fields``."""
+    logger.log(level, event, extra={"fields": fields})
+
+
+def log_error(event: str, error: BaseException, **fields):
+    log(event, logging.ERROR, error=f"{type(error).__name__}: {error}", **fields)
@@ -1,18 +1,42 @@
 import asyncio
+from functools import partial
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-import aiohttp
 
-from db import init_db, add_user
-from keys import API_TOKEN, SAD_PIC_FILE_ID, HELLO_PIC_FILE_ID
+from api import ApiClient, ApiUnavailable
+from assets import AssetRegistry
+from cache import ResultCache
+from config import METRICS_PORT, TELEGRAM_API_URL, WEBHOOK_URL, WORKBOOK_MAX_BYTES, WORKBOOK_SEND_COMPACT
+from db import init_db, register_user, close_db
+from files import content_key, stream_telegram_file
+from jobs import JobQueue, QueueFull, JobAlreadyActive, edit_position
+from keys import API_TOKEN
+from log import log, log_error
+from metrics import HandlerTimingMiddleware, span, start_metrics_server
+from storage import SQLiteStorage
+from throttle import SendThrottle
+from webhook import run_webhook
+from workbook import WorkbookReader, WorkbookError
 
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=session)
+throttle = SendThrottle()
+bot.session.middleware(throttle)
+api = ApiClient(cache=ResultCache())
+assets = AssetRegistry()
+assets.add_pictures()
+jobs = JobQueue()
+workbooks = WorkbookReader()
+storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
+dp.message.middleware(HandlerTimingMiddleware())
+dp.callback_query.middleware(HandlerTimingMiddleware())
+metrics_runner = None
 
 class ManualInputStates(StatesGroup):
     waiting_for_kwh = State()
@@ -20,7 +44,13 @@ class ManualInputStates(StatesGroup):
     waiting_for_mwh = State()
     waiting_for_max_power = State()
 
-print("Bot started")
+log("bot started")
+
+QUEUE_FULL_TEXT = "Сейчас слишком много запросов :( Попробуйте ещё раз через пару минут."
+API_UNAVAILABLE_TEXT = "Сервис расчёта сейчас недоступен :( Мы уже разбираемся, попробуйте ещё раз через пару минут."
+JOB_ACTIVE_TEXT = "Ваш предыдущий расчёт ещё выполняется, дождитесь результата."
+WORKBOOK_TOO_BIG_TEXT = "Файл слишком большой. Нужна выгрузка почасовых показаний счётчика за период до года."
+WORKBOOK_ERROR_TEXT = "Не получилось прочитать файл: {}. Нужна выгрузка почасовых показаний счётчика в формате .xlsx"
 
 def manual_input_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -38,8 +68,7 @@ def voltage_selection_keyboard():
 @dp.message(Command("start"))
 async def start(message: types.Message):
 
-    is_new_user = await add_user(message.from_user.id, message.from_user.username or "unknown")
-    print(is_new_user)
+    is_new_user = register_user(message.from_user.id, message.from_user.username or "unknown")
     greeting = (
         "Мы разработали сервис, который помогает юридическим лицам быстро и точно подобрать оптимальный тариф на электроэнергию, основываясь на данных потребления."
         "\n\n📂 Отправь Excel-файл с показаниями счетчиков (формат .xlsx), и мы:"
@@ -49,19 +78,20 @@ async def start(message: types.Message):
         "\n\n📲 Или выбери ручной ввод, если таблиц под рукой пока нет."
         "\n\n🔍 Наш сервис работает быстро и понятно — без сложных расчетов, графиков и бюрократии. Поможем сократить принятие решений с нескольких дней до пары минут."
     )
-    print('user started bot', message.from_user.id)
-    sent_message = await message.answer_photo(
-        HELLO_PIC_FILE_ID,
-        caption=greeting,
-        reply_markup=manual_input_keyboard()
-    )
-    print('photo send')
+    log("user started bot", user_id=message.from_user.id, is_new=is_new_user)
+    with span("reply_send"):
+        sent_message = await assets.send(
+            "hello",
+            message.answer_photo,
+            caption=greeting,
+            reply_markup=manual_input_keyboard()
+        )
     if is_new_user:
         try:
             await bot.pin_chat_message(chat_id=message.chat.id, message_id=sent_message.message_id)
-            print('pinned message')
+            log("greeting pinned", chat_id=message.chat.id)
         except Exception as e:
-            print(f"Не удалось закрепить сообщение: {e}")
+            log_error("pin failed", e, chat_id=message.chat.id)
 
 
 
@@ -72,43 +102,55 @@ async def handle_excel(message: types.Message):
     if not document.file_name.lower().endswith(".xlsx"):
         await message.answer("Нужен файл в формате .xlsx")
         return
+    if document.file_size and document.file_size > WORKBOOK_MAX_BYTES:
+        await message.answer(WORKBOOK_TOO_BIG_TEXT)
+        return
 
-    processing_msg = await message.answer("Обрабатываю файл...")
-
-    file = await bot.download(document.file_id)
-    file_data = file.read()
-
-    url = "https://etf-team.ru/api/volumes-info?return_resolved=true"
+    processing_text = "Обрабатываю файл..."
+    processing_msg = await message.answer(processing_text)
 
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
-    async with aiohttp.ClientSession() as session:
-        form = aiohttp.FormData()
-        form.add_field(
-            name='payload',
-            value=file_data,
-            filename=document.file_name,
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    try:
+        # validation reads the file once; the upload streams it again unless the result is cached
+        key = content_key(document.file_unique_id)
+        file_data = partial(stream_telegram_file, bot, document.file_id)
+        profile = await workbooks.profile(key, file_data)
+        if WORKBOOK_SEND_COMPACT:
+            file_data = await workbooks.compact(profile)
+        response = await jobs.submit(
+            message.from_user.id,
+            lambda: api.volumes_info(
+                file_data,
+                document.file_name,
+                content_key=key,
+            ),
+            on_position=edit_position(processing_msg, processing_text),
         )
-
-        try:
-            async with session.post(url, data=form) as response:
-                if response.status == 200:
-                    result = await response.text()
-                    await message.answer(f"Ответ:\n{result}")
-                else:
-                    bad = (f"Что-то пошло не так! :( \nНаш администратор уже уведомлен об ошибке и мы ее обязательно изучим! "
-                           f"\nПопробуйте ввести данные ещё раз. \nКод ошибки: {response.status}")
-                    await message.answer_photo(SAD_PIC_FILE_ID, caption=bad)
-        except Exception as e:
-            bad = f"Ошибка при отправке файла: {e}"
-            await message.answer_photo(SAD_PIC_FILE_ID, caption=bad)
-        finally:
-            await processing_msg.delete()
+        if response.status == 200:
+            with span("reply_send"):
+                await message.answer(f"Ответ:\n{response.text}")
+        else:
+            bad = (f"Что-то пошло не так! :( \nНаш администратор уже уведомлен об ошибке и мы ее обязательно изучим! "
+                   f"\nПопробуйте ввести данные ещё раз. \nКод ошибки: {response.status}")
+            await assets.send("sad", message.answer_photo, caption=bad)
+    except WorkbookError as e:
+        await message.answer(WORKBOOK_ERROR_TEXT.format(e))
+    except QueueFull:
+        await message.answer(QUEUE_FULL_TEXT)
+    except JobAlreadyActive:
+        await message.answer(JOB_ACTIVE_TEXT)
+    except ApiUnavailable:
+        await assets.send("sad", message.answer_photo, caption=API_UNAVAILABLE_TEXT)
+    except Exception as e:
+        bad = f"Ошибка при отправке файла: {e}"
+        await assets.send("sad", message.answer_photo, caption=bad)
+    finally:
+        await processing_msg.delete()
 
 @dp.callback_query(F.data == "manual_input")
 async def manual_input(callback: CallbackQuery, state: FSMContext):
-    await callback.message.answer("Введите количество потреблённой электроэнергии (в кВт·ч):")
     await state.set_state(ManualInputStates.waiting_for_kwh)
+    await callback.message.answer("Введите количество потреблённой электроэнергии (в кВт·ч):")
     await callback.answer()
 
 @dp.message(ManualInputStates.waiting_for_kwh)
@@ -116,8 +158,8 @@ async def process_kwh(message: types.Message, state: FSMContext):
     try:
         kwh = float(message.text)
         await state.update_data(kwh=kwh)
-        await message.answer("Какая максимальная потребляемая мощность? (в кВт·ч):")
         await state.set_state(ManualInputStates.waiting_for_max_power)
+        await message.answer("Какая максимальная потребляемая мощность? (в кВт·ч):")
     except ValueError:
         await message.answer("Пожалуйста, введите корректное число (например, 150.5)")
 
@@ -126,15 +168,16 @@ async def process_max_power(message: types.Message, state: FSMContext):
     try:
         kwh_max = float(message.text)
         await state.update_data(kwh_max=kwh_max)
+        await state.set_state(ManualInputStates.waiting_for_voltage)
         voltage_msg = await message.answer("Выберите ваше напряжение:", reply_markup=voltage_selection_keyboard())
         await state.update_data(voltage_msg_id=voltage_msg.message_id)
-        await state.set_state(ManualInputStates.waiting_for_voltage)
     except ValueError:
         await message.answer("Пожалуйста, введите корректное число (например, 150.5)")
 
 @dp.callback_query(ManualInputStates.waiting_for_voltage)
 async def voltage_selected(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text("Обработка данных...")
+    processing_text = "Обработка данных..."
+    await callback.message.edit_text(processing_text)
     voltage_map = {
         "voltage_high": 1,
         "voltage_medium": 2,
@@ -158,30 +201,61 @@ async def voltage_selected(callback: CallbackQuery, state: FSMContext):
         "kwhmax": kwh_max,
         "voltage": voltage
     }
-    print(payload)
-
-    url = "https://etf-team.ru/api/volumes-info?return_resolved=true"
+    log("manual calculation", user_id=callback.from_user.id, **payload)
 
     await bot.send_chat_action(chat_id=callback.message.chat.id, action="typing")
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(url, json=payload) as response:
-                if response.status == 200:
-                    result = await response.text()
-                    await callback.message.edit_text(f"Ответ:\n{result}")
-                else:
-                    bad = (f"Что-то пошло не так! :( \nНаш администратор уже уведомлен об ошибке и мы ее обязательно изучим! "
-                           f"\nПопробуйте ввести данные ещё раз. \nКод ошибки: {response.status}")
-                    await callback.message.answer_photo(SAD_PIC_FILE_ID, caption=bad)
-        except Exception as e:
-            await callback.message.edit_text(f"Ошибка при отправке: {e}")
-        finally:
-            await state.clear()
-            await callback.answer()
+    try:
+        response = await jobs.submit(
+            callback.from_user.id,
+            lambda: api.volumes_info_manual(payload),
+            on_position=edit_position(callback.message, processing_text),
+        )
+        if response.status == 200:
+            with span("reply_send"):
+                await callback.message.edit_text(f"Ответ:\n{response.text}")
+        else:
+            bad = (f"Что-то пошло не так! :( \nНаш администратор уже уведомлен об ошибке и мы ее обязательно изучим! "
+                   f"\nПопробуйте ввести данные ещё раз. \nКод ошибки: {response.status}")
+            await assets.send("sad", callback.message.answer_photo, caption=bad)
+    except QueueFull:
+        await callback.message.edit_text(QUEUE_FULL_TEXT)
+    except JobAlreadyActive:
+        await callback.message.edit_text(JOB_ACTIVE_TEXT)
+    except ApiUnavailable:
+        await assets.send("sad", callback.message.answer_photo, caption=API_UNAVAILABLE_TEXT)
+    except Exception as e:
+        await callback.message.edit_text(f"Ошибка при отправке: {e}")
+    finally:
+        await state.clear()
+        await callback.answer()
 
-async def main():
+async def on_startup(worker_index: int = 0, workers: int = 1):
+    global metrics_runner
+    throttle.share(workers)
     await init_db()
-    await dp.start_polling(bot)
+    await assets.load(bot.id)
+    await api.start()
+    await jobs.start()
+    await workbooks.start()
+    storage.start()
+    metrics_runner = await start_metrics_server(port=METRICS_PORT + worker_index if METRICS_PORT else None)
+
+async def on_shutdown():
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await jobs.close()
+    await workbooks.close()
+    await api.close()
+    await close_db()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+async def main():
+    if WEBHOOK_URL:
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == '__main__':
     asyncio.run(main())
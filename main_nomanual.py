@@ -1,20 +1,61 @@
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaDocument
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-import aiohttp
 import asyncio
 import datetime
-
-from db import init_db, add_user, get_all_users
-from keys import API_TOKEN, SAD_PIC_FILE_ID, HELLO_PIC_FILE_ID, TEST_FILE_PATH, HA_PIC_FILE_ID, HAHA_PIC_FILE_ID
-
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+from functools import partial
+
+from api import ApiClient, ApiUnavailable
+from assets import AssetRegistry
+from broadcast import Broadcast
+from cache import ResultCache
+from config import (REMINDER_CRON, CACHE_SWEEP_CRON, METRICS_PORT, TELEGRAM_API_URL, TEST_FILE_PATH, WEBHOOK_URL,
+                    WORKBOOK_MAX_BYTES, WORKBOOK_SEND_COMPACT, COST_ENGINE)
+from costs import CATEGORIES, CategoryCost, CostEngine
+from db import init_db, register_user, close_db
+from files import content_key, open_file_data, stream_telegram_file
+from jobs import JobQueue, QueueFull, JobAlreadyActive, edit_position
+from keys import API_TOKEN
+from log import log, log_error
+from metrics import HandlerTimingMiddleware, span, start_metrics_server
+from scheduler import Scheduler
+from storage import SQLiteStorage
+from throttle import SendThrottle
+from webhook import run_webhook
+from workbook import WorkbookReader, WorkbookError
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=session)
+throttle = SendThrottle()
+bot.session.middleware(throttle)
+api = ApiClient(cache=ResultCache())
+assets = AssetRegistry()
+assets.add_pictures()
+assets.add("test_file", TEST_FILE_PATH, keep_data=True)
+jobs = JobQueue()
+workbooks = WorkbookReader()
+cost_engine = CostEngine()
+scheduler = Scheduler()
+storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
-print("bot started")
+dp.message.middleware(HandlerTimingMiddleware())
+dp.callback_query.middleware(HandlerTimingMiddleware())
+metrics_runner = None
+log("bot started")
+
+QUEUE_FULL_TEXT = "Сейчас слишком много запросов :( Попробуйте отправить значение ещё раз через пару минут."
+API_UNAVAILABLE_TEXT = ("Сервис расчёта сейчас недоступен :( Мы уже разбираемся. "
+                        "Попробуйте отправить значение ещё раз через пару минут.")
+JOB_ACTIVE_TEXT = "Ваш предыдущий расчёт ещё выполняется, дождитесь результата."
+WORKBOOK_TOO_BIG_TEXT = "Файл слишком большой. Нужна выгрузка почасовых показаний счётчика за период до года."
+WORKBOOK_ERROR_TEXT = "Не получилось прочитать файл: {}. Нужна выгрузка почасовых показаний счётчика в формате .xlsx"
+LOCAL_ROWS_NOTE = "<em>** Предварительный расчёт по справочным тарифам.</em>"
+LOCAL_COSTS_NOTE = "<em>Сервис расчёта сейчас недоступен, поэтому все цифры предварительные.</em>"
+CATEGORY_NUMBERS = {"FIRST": 1, "SECOND": 2, "THIRD": 3, "FORTH": 4, "FIFTH": 5, "SIXTH": 6}
 
 class Form(StatesGroup):
     waiting_for_voltage = State()
@@ -54,7 +95,7 @@ def contract_keyboard():
 
 @dp.message(Command("start"))
 async def start(message: types.Message):
-    is_new_user = await add_user(message.from_user.id, message.from_user.username or "unknown")
+    is_new_user = register_user(message.from_user.id, message.from_user.username or "unknown")
     greeting = (
         "Мы разработали сервис, который помогает юридическим лицам быстро и точно подобрать оптимальный тариф на электроэнергию, основываясь на данных потребления."
         "\n\n📂 Отправь Excel-файл с показаниями счетчиков (формат .xlsx), и мы:"
@@ -64,8 +105,9 @@ async def start(message: types.Message):
         "\n\n📲 Если у вас нет файла, мы подготовили тестовый файл, который можно использовать в качестве примера. Просто нажмите кнопку ниже, и проверьте наш сервис!"
         "\n\n🔍 Наш сервис работает быстро и понятно — без сложных расчетов, графиков и бюрократии. Поможем сократить принятие решений с нескольких дней до пары минут."
     )
-    sent_message = await message.answer_photo(
-        HELLO_PIC_FILE_ID,
+    sent_message = await assets.send(
+        "hello",
+        message.answer_photo,
         caption=greeting,
         reply_markup=manual_input_keyboard()
     )
@@ -73,7 +115,7 @@ async def start(message: types.Message):
         try:
             await bot.pin_chat_message(chat_id=message.chat.id, message_id=sent_message.message_id)
         except Exception as e:
-            print(f"Не удалось закрепить сообщение: {e}")
+            log_error("pin failed", e, chat_id=message.chat.id)
 
 @dp.message(lambda msg: msg.document is not None)
 async def handle_excel(message: types.Message, state: FSMContext):
@@ -82,26 +124,37 @@ async def handle_excel(message: types.Message, state: FSMContext):
     if not document.file_name.lower().endswith(".xlsx"):
         await message.answer("Нужен файл в формате .xlsx")
         return
-
+    if document.file_size and document.file_size > WORKBOOK_MAX_BYTES:
+        await message.answer(WORKBOOK_TOO_BIG_TEXT)
+        return
     processing_msg = await message.answer("Обрабатываю файл...")
+    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+    try:
+        await workbooks.profile(content_key(document.file_unique_id),
+                                partial(stream_telegram_file, bot, document.file_id))
+    except WorkbookError as e:
+        await message.answer(WORKBOOK_ERROR_TEXT.format(e))
+        return
+    except Exception as e:
+        log_error("upload failed", e, user_id=message.from_user.id)
+        await assets.send("sad", message.answer_photo, caption=f"Ошибка при получении файла: {e}")
+        return
+    finally:
+        await processing_msg.delete()
 
-    file = await bot.download(document.file_id)
-    file_data = file.read()
-
-
-    await state.update_data(file_data=file_data, filename=document.file_name)
+    await state.update_data(file_id=document.file_id, file_unique_id=document.file_unique_id, filename=document.file_name)
 
-    await message.answer("<b>Какое у вас напряжение?</b>", reply_markup=voltage_keyboard(), parse_mode="HTML")
+    # the state is set before the question goes out, so an answer right away finds it
     await state.set_state(Form.waiting_for_voltage)
-    await processing_msg.delete()
+    await message.answer("<b>Какое у вас напряжение?</b>", reply_markup=voltage_keyboard(), parse_mode="HTML")
 
 @dp.callback_query(Form.waiting_for_voltage, F.data.in_(["BH", "CH1", "CH11", "HH"]))
 async def process_voltage(callback: CallbackQuery, state: FSMContext):
     voltage = callback.data
     await state.update_data(voltage_category=voltage)
 
-    await callback.message.edit_text("<b>Какой договор вы заключаете?</b>", reply_markup=contract_keyboard(), parse_mode="HTML")
     await state.set_state(Form.waiting_for_contract)
+    await callback.message.edit_text("<b>Какой договор вы заключаете?</b>", reply_markup=contract_keyboard(), parse_mode="HTML")
     await callback.answer()
 
 @dp.callback_query(Form.waiting_for_contract, F.data.in_(["contract_false", "contract_true"]))
@@ -109,11 +162,83 @@ async def process_contract(callback: CallbackQuery, state: FSMContext):
     contract_data = callback.data
     contract = True if contract_data == "contract_true" else False
     await state.update_data(contract_type=contract)
-    await callback.message.edit_text("<b>Какое максимальное напряжение?</b> \n\n<em>Введите численное значение в кВт/ч</em>", parse_mode="HTML")
     await state.set_state(Form.waiting_for_max_voltage)
+    await callback.message.edit_text("<b>Какое максимальное напряжение?</b> \n\n<em>Введите численное значение в кВт/ч</em>", parse_mode="HTML")
     await callback.answer()
 
 
+def backend_costs(data: dict) -> dict:
+    """Category number -> CategoryCost from a /api/clients/cases response."""
+    result = {}
+    for cat in data.get("categories", []):
+        num = CATEGORY_NUMBERS.get(cat.get("category_type", "").upper())
+        if num:
+            applicability = cat["applicability"]
+            result[num] = CategoryCost(num, float(cat.get("total_cost", 0)),
+                                       applicability["is_applicable_power_capacity"],
+                                       int(applicability["power_capacity_change_recommendation"]))
+    return result
+
+
+def costs_text(costs: dict, local: set = frozenset()) -> str:
+    """Reply text; the categories in ``local`` came from the local engine and are marked as such."""
+    lines = []
+    for num in CATEGORIES:
+        cost = costs.get(num)
+        if cost is None:
+            lines.append(f"ЦК {num} — В разработке")
+        else:
+            note_marker = " *" if not cost.applicable else ""
+            if num in local:
+                note_marker += " **"
+            lines.append(f"ЦК {num} — {cost.total_cost / 1000:.0f} т.р. / мес{note_marker}")
+    final = (
+        "🔎 <b>Основываясь на вашем месячном потреблении, мы вычислили будущие расходы по нескольким ценовым категориям:</b>\n\n"
+        + "\n".join(lines)
+    )
+    first = costs.get(1)
+    if first is not None and not first.applicable:
+        final += (
+            "\n\n<em>* Чтобы воспользоваться ЦК1, уменьшите величину максимальной мощности "
+            f"на {first.recommendation}кВт, обратившись в сетевую организацию.</em>"
+        )
+    if local & costs.keys():
+        final += "\n\n" + LOCAL_ROWS_NOTE
+    return final
+
+
+async def send_costs(message: types.Message, costs: dict, local: set = frozenset(), note: str = None):
+    final = costs_text(costs, local)
+    if note:
+        final += "\n\n" + note
+    with span("reply_send"):
+        await assets.send(
+            "haha",
+            message.answer_photo,
+            caption=final,
+            parse_mode="HTML"
+        )
+
+
+async def send_bad_response(message: types.Message, text: str):
+    bad = (
+        f"Что-то пошло не так! :( \n\nНаш администратор уже уведомлен об ошибке и мы ее обязательно изучим! "
+        f"\nПопробуйте ввести данные ещё раз. \nОтвет: {text}")
+    await assets.send("sad", message.answer_photo, caption=bad)
+
+
+async def local_costs(file_key: str, file_data, voltage_category: str, contract_type: bool,
+                      max_voltage: int):
+    """Costs from the local engine, or None when the profile is not at hand without a download."""
+    profile = workbooks.cached(file_key)
+    if profile is None and isinstance(file_data, bytes):
+        profile = await workbooks.profile(file_key, file_data)
+    if profile is None:
+        return None
+    with span("cost_engine"):
+        return cost_engine.costs(profile, voltage_category, contract_type, max_voltage)
+
+
 @dp.message(Form.waiting_for_max_voltage)
 async def process_max_voltage(message: types.Message, state: FSMContext):
     try:
@@ -125,99 +250,78 @@ async def process_max_voltage(message: types.Message, state: FSMContext):
     await state.update_data(max_voltage=max_voltage)
 
     data = await state.get_data()
-    file_data = data["file_data"]
+    if data.get("asset"):
+        file_data = await assets.data(data["asset"])
+        file_key = assets.content_key(data["asset"])
+    else:
+        file_data = partial(open_file_data, bot, data)
+        file_key = content_key(data.get("file_unique_id"), data.get("file_path"))
     filename = data["filename"]
     voltage_category = data["voltage_category"]
     contract_type = data["contract_type"]
 
-    contract_str = "true" if contract_type else "false"
-
-    url = (
-        f"https://etf-team.ru/api/clients/cases?"
-        f"is_transmission_included={contract_str}&"
-        f"max_power_capacity_kwt={max_voltage}&"
-        f"voltage_category={voltage_category}"
-    )
+    local = None
+    if COST_ENGINE != "off":
+        # optional: whatever goes wrong here, the backend still gets asked
+        try:
+            local = await local_costs(file_key, file_data, voltage_category, contract_type, max_voltage)
+        except Exception as e:
+            log_error("local costs failed", e, user_id=message.from_user.id)
+    if COST_ENGINE == "local" and local is not None:
+        await send_costs(message, local, set(local))
+        await state.clear()
+        return
+    if WORKBOOK_SEND_COMPACT:
+        # the user's own file is sent when it cannot be compacted
+        try:
+            file_data = await workbooks.compact(await workbooks.profile(file_key, file_data))
+        except Exception as e:
+            log_error("workbook compaction failed", e, user_id=message.from_user.id)
 
-    processing_msg = await message.answer("Отправляю данные на сервер...")
+    processing_text = "Отправляю данные на сервер..."
+    processing_msg = await message.answer(processing_text)
 
-    async with aiohttp.ClientSession() as session:
-        form = aiohttp.FormData()
-        form.add_field(
-            name='payload',
-            value=file_data,
-            filename=filename,
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    try:
+        resp = await jobs.submit(
+            message.from_user.id,
+            lambda: api.client_cases(
+                file_data, filename, voltage_category, contract_type, max_voltage,
+                content_key=file_key,
+            ),
+            on_position=edit_position(processing_msg, processing_text),
         )
-        headers = {"accept": "application/json"}
-
-        async with session.post(url, data=form, headers=headers) as resp:
-            text = await resp.text()
-            print(resp.status)
-            text = await resp.text()
-            if resp.status == 200 or 201:
-                try:
-                    data = await resp.json()
-                    categories = data.get("categories", [])
-
-                    result_map = {
-                        1: "ЦК 1 — В разработке",
-                        2: "ЦК 2 — В разработке",
-                        3: "ЦК 3 — В разработке",
-                        4: "ЦК 4 — В разработке",
-                        5: "ЦК 5 — В разработке",
-                        6: "ЦК 6 — В разработке"
-                    }
-
-                    note_needed = False
-                    recommendation_kw = 0
-
-                    for cat in categories:
-                        cat_type = cat.get("category_type", "").upper()
-                        total_cost = float(cat.get("total_cost", 0)) / 1000
-                        applicable = cat["applicability"]["is_applicable_power_capacity"]
-                        recommendation = int(cat["applicability"]["power_capacity_change_recommendation"])
-
-                        note_marker = " *" if not applicable else ""
-
-                        num = {"FIRST": 1, "SECOND": 2, "THIRD": 3, "FORTH": 4}.get(cat_type)
-                        if num:
-                            result_map[num] = f"ЦК {num} — {total_cost:.0f} т.р. / мес{note_marker}"
-
-
-                        if cat_type == "FIRST" and not applicable:
-                            note_needed = True
-                            recommendation_kw = recommendation
-
-
-                    final = (
-                        "🔎 <b>Основываясь на вашем месячном потреблении, мы вычислили будущие расходы по нескольким ценовым категориям:</b>\n\n"
-                        f"{result_map[1]}\n"
-                        f"{result_map[2]}\n"
-                        f"{result_map[3]}\n"
-                        f"{result_map[4]}\n"
-                        f"{result_map[5]}\n"
-                        f"{result_map[6]}"
-                    )
-
-
-                    if note_needed:
-                        final += (
-                            "\n\n<em>* Чтобы воспользоваться ЦК1, уменьшите величину максимальной мощности "
-                            f"на {recommendation_kw}кВт, обратившись в сетевую организацию.</em>"
-                        )
-
-                    await message.answer_photo(
-                        HAHA_PIC_FILE_ID,
-                        caption=final,
-                        parse_mode="HTML"
-                    )
-
-                except Exception as e:
-                    bad = (
-                        f"Что-то пошло не так! :( \n\nНаш администратор уже уведомлен об ошибке и мы ее обязательно изучим! "
-                        f"\nПопробуйте ввести данные ещё раз. \nОтвет: {text}")
-                    await message.answer_photo(SAD_PIC_FILE_ID, caption=bad)
+    except QueueFull:
+        await processing_msg.edit_text(QUEUE_FULL_TEXT)
+        return
+    except JobAlreadyActive:
+        await processing_msg.edit_text(JOB_ACTIVE_TEXT)
+        return
+    except ApiUnavailable:
+        await processing_msg.delete()
+        if local is None:
+            await assets.send("sad", message.answer_photo, caption=API_UNAVAILABLE_TEXT)
+            return
+        await send_costs(message, local, set(local), LOCAL_COSTS_NOTE)
+        await state.clear()
+        return
+    text = resp.text
+    log("clients cases response", user_id=message.from_user.id, status=resp.status)
+    if resp.status in (200, 201):
+        try:
+            with span("json_parse"):
+                data = resp.json()
+            # the backend's figures win, the local engine fills in the categories it leaves out
+            backend = backend_costs(data)
+            costs = dict(local or {})
+            costs.update(backend)
+            await send_costs(message, costs, costs.keys() - backend.keys())
+
+        except Exception as e:
+            await send_bad_response(message, text)
+    elif resp.status >= 500 and local is not None:
+        await send_costs(message, local, set(local), LOCAL_COSTS_NOTE)
+    else:
+        await send_bad_response(message, text)
 
     await processing_msg.delete()
     await state.clear()
@@ -226,7 +330,7 @@ async def process_max_voltage(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data == "manual_input")
 async def manual_input_prompt(callback: CallbackQuery):
     a = ("Хочешь протестировать наш сервис на примере тестового Excel-файла?")
-    await callback.message.answer_photo(HA_PIC_FILE_ID, caption=a, reply_markup=confirm_test_file_keyboard())
+    await assets.send("ha", callback.message.answer_photo, caption=a, reply_markup=confirm_test_file_keyboard())
 
     await callback.answer()
 
@@ -234,50 +338,80 @@ async def manual_input_prompt(callback: CallbackQuery):
 @dp.callback_query(F.data == "send_test_file")
 async def send_test_file(callback: CallbackQuery, state: FSMContext):
     try:
-        with open(TEST_FILE_PATH, "rb") as f:
-            file_data = f.read()
-        await state.update_data(file_data=file_data, filename="test_file.xlsx")
+        await state.update_data(asset="test_file", filename="test_file.xlsx")
 
-        await bot.send_document(
-            chat_id=callback.message.chat.id,
-            document=types.FSInputFile(TEST_FILE_PATH),
+        await assets.send(
+            "test_file",
+            callback.message.answer_document,
             caption="Вот пример тестового файла, который я отправлю на сервер"
         )
 
+        await state.set_state(Form.waiting_for_voltage)
         await bot.send_message(
             chat_id=callback.message.chat.id,
             text="Какое у вас напряжение?",
             reply_markup=voltage_keyboard()
         )
-        await state.set_state(Form.waiting_for_voltage)
     except Exception as e:
-        await callback.message.answer_photo(
-            SAD_PIC_FILE_ID,
+        await assets.send(
+            "sad",
+            callback.message.answer_photo,
             caption=f"Ошибка при отправке файла пользователю: {e}"
         )
     await callback.answer()
 
-async def reminder():
-    while True:
-        now = datetime.datetime.now()
-        if now.day == 15:
-            user_ids = await get_all_users()
-            for user_id in user_ids:
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="Доброго времени суток!\nНапоминаем, что необходимо обновить данные с счетчиков для получения актуальных тарифов. Обновите пожалуйста информацию по счетчикам."
-                    )
-                except Exception as e:
-                    print(f"error to send message {user_id}")
-        await asyncio.sleep(48 * 60 * 60)
+REMINDER_TEXT = (
+    "Доброго времени суток!\nНапоминаем, что необходимо обновить данные с счетчиков для получения актуальных тарифов. "
+    "Обновите пожалуйста информацию по счетчикам."
+)
 
+async def reminder(fire_time: datetime.datetime):
+    broadcast = Broadcast(bot, f"reminder-{fire_time:%Y-%m}", REMINDER_TEXT)
+    counts = await broadcast.run()
+    log("reminder sent", **counts)
 
-async def main():
+
+async def sweep_cache(fire_time: datetime.datetime):
+    await api.cache.sweep()
+
+
+scheduler.add("reminder", REMINDER_CRON, reminder)
+scheduler.add("cache-sweep", CACHE_SWEEP_CRON, sweep_cache)
+
+
+async def on_startup(run_scheduler: bool = True, worker_index: int = 0, workers: int = 1):
+    global metrics_runner
+    throttle.share(workers)
     await init_db()
+    await assets.load(bot.id)
+    await api.start()
+    await jobs.start()
+    await workbooks.start()
+    storage.start()
+    if run_scheduler:
+        await scheduler.start()
+    metrics_runner = await start_metrics_server(port=METRICS_PORT + worker_index if METRICS_PORT else None)
 
-    asyncio.create_task(reminder())
-    await dp.start_polling(bot)
+
+async def on_shutdown():
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await scheduler.close()
+    await jobs.close()
+    await workbooks.close()
+    await api.close()
+    await close_db()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+async def main():
+    if WEBHOOK_URL:
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,70 @@
+import random
+import time
+from collections import deque
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for retry number ``attempt`` (0-based)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyWindow:
+    """Durations of the last ``size`` successful calls, for percentile estimates."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float):
+        """``q``-th percentile, or None until ``min_samples`` calls were seen."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Stops calls to a backend after ``failures`` failures in a row.
+
+    While open, ``allow()`` is False for ``reset_timeout`` seconds; then one
+    probe call is let through and its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.opened = 0
+        self._failed = 0
+        self._opened_at = None
+        self._probe_at = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self.reset_timeout:
+            return False
+        # half-open: one probe at a time, a new one if the last never reported back
+        if self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+            return False
+        self._probe_at = now
+        return True
+
+    def success(self):
+        self._failed = 0
+        self._opened_at = self._probe_at = None
+
+    def failure(self):
+        self._failed += 1
+        if self._opened_at is not None or self._failed >= self.failures:
+            if self._opened_at is None:
+                self.opened += 1
+            self._opened_at = time.monotonic()
+            self._probe_at = None
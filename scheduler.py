@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+
+import db
+from log import log_error
+
+MAX_SLEEP = 60 * 60
+RETRY_DELAY = 60
+
+FIELD_RANGES = (
+    (0, 59),   # minute
+    (0, 23),   # hour
+    (1, 31),   # day of month
+    (1, 12),   # month
+    (0, 6),    # day of week, 0 = Sunday
+)
+
+
+def _parse_field(field: str, low: int, high: int) -> frozenset:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/")
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-"))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f"bad cron field {field!r}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Cron:
+    """Five-field cron expression: minute hour day-of-month month day-of-week."""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_RANGES)
+        )
+        # like cron, a restricted day-of-month and day-of-week match either one
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime.datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        """First fire time strictly after ``moment``."""
+        moment = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                year, month = divmod(moment.month, 12)
+                moment = moment.replace(year=moment.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron expression never fires: {self.expression!r}")
+
+
+class Scheduler:
+    """Runs periodic jobs at their cron times, at most once per fire time.
+
+    The last completed fire time of every job is kept in SQLite. A fire time
+    missed while the bot was down is run once on startup, and a job that fails
+    is retried until it completes.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._tasks = []
+
+    def add(self, name: str, cron: str, func):
+        """Register ``func(fire_time)``, a coroutine function, under ``name``."""
+        self._jobs[name] = (Cron(cron), func)
+
+    async def _run_job(self, name: str, cron: Cron, func):
+        last_run = await db.get_job_last_run(name)
+        if last_run is not None:
+            fire_time = cron.next_after(datetime.datetime.fromisoformat(last_run))
+        else:
+            fire_time = cron.next_after(datetime.datetime.now())
+        while True:
+            delay = (fire_time - datetime.datetime.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(min(delay, MAX_SLEEP))
+                continue
+            try:
+                await func(fire_time)
+            except Exception as e:
+                log_error("scheduled job failed", e, job=name)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            await db.set_job_last_run(name, fire_time.isoformat())
+            fire_time = cron.next_after(max(fire_time, datetime.datetime.now()))
+
+    async def start(self):
+        for name, (cron, func) in self._jobs.items():
+            self._tasks.append(asyncio.create_task(self._run_job(name, cron, func)))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,190 @@
+"""Run a bot as one update-intake process and N worker processes.
+
+    python shard.py [main_nomanual|main] [workers]
+
+The intake long-polls getUpdates and routes every update to the worker
+chosen by its chat id, so all updates of a chat are handled in order by the
+same process. Each worker runs the module's ``dp`` with its startup and
+shutdown hooks; only worker 0 runs the scheduler, worker i serves
+metrics on METRICS_PORT + i and every worker sends at its share of
+SEND_RATE. Crashed workers are started again.
+
+SIGTERM or SIGINT to the intake stops polling and lets every worker finish
+its updates and shutdown hooks. Workers ignore both signals and exit on
+their own if the intake dies without stopping them.
+"""
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import queue as queue_module
+import signal
+import sys
+from contextlib import suppress
+
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+
+from config import SHARD_WORKERS, SHARD_CONCURRENCY
+from log import log, log_error
+
+POLL_TIMEOUT = 25
+SUPERVISE_INTERVAL = 1.0
+# how often a worker waiting for updates checks that the intake is still there
+PARENT_CHECK_INTERVAL = 5.0
+STOP_TIMEOUT = 30
+
+
+def chat_key(update) -> int:
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.chat is not None:
+        return context.chat.id
+    if context.user is not None:
+        return context.user.id
+    return update.update_id
+
+
+async def _handle_in_order(dp, bot, update: dict, previous, semaphore: asyncio.Semaphore):
+    if previous is not None:
+        await asyncio.wait([previous])
+    async with semaphore:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            log_error("update failed", e, update_id=update.get("update_id"))
+
+
+def _forget_tail(tails: dict, key: int, task: asyncio.Task):
+    if tails.get(key) is task:
+        del tails[key]
+
+
+async def _serve(module_name: str, index: int, workers: int, queue, concurrency: int):
+    module = importlib.import_module(module_name)
+    dp, bot = module.dp, module.bot
+    workflow_data = {"dispatcher": dp, "bots": [bot], "run_scheduler": index == 0, "worker_index": index,
+                     "workers": workers, **dp.workflow_data}
+    await dp.emit_startup(bot=bot, **workflow_data)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    # last task per chat: the next update of that chat waits for it
+    tails = {}
+    try:
+        while True:
+            try:
+                item = await loop.run_in_executor(None, queue.get, True, PARENT_CHECK_INTERVAL)
+            except queue_module.Empty:
+                # the worker holds its queue's write end too, so a dead intake never shows as EOF
+                if not multiprocessing.parent_process().is_alive():
+                    log("intake gone, worker stopping", logging.WARNING, worker=index)
+                    break
+                continue
+            if item is None:
+                break
+            key, update = item
+            task = asyncio.create_task(_handle_in_order(dp, bot, update, tails.get(key), semaphore))
+            tails[key] = task
+            task.add_done_callback(lambda t, key=key: _forget_tail(tails, key, t))
+        if tails:
+            await asyncio.wait(list(tails.values()))
+    finally:
+        await dp.emit_shutdown(bot=bot, **workflow_data)
+        await bot.session.close()
+
+
+def _worker_main(module_name: str, index: int, workers: int, queue, concurrency: int):
+    # the intake stops workers through their queues; Ctrl+C or a stop signal sent
+    # to the whole process group is for it alone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_serve(module_name, index, workers, queue, concurrency))
+
+
+class ShardedRunner:
+    def __init__(self, module_name: str = "main_nomanual", workers: int = SHARD_WORKERS,
+                 concurrency: int = SHARD_CONCURRENCY):
+        self.module_name = module_name
+        self.workers = workers
+        self.concurrency = concurrency
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self.restarts = 0
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.module_name, index, self.workers, self._queues[index], self.concurrency),
+            name=f"bot-worker-{index}",
+            # not a daemon: daemons may not start processes (the workbook pool), and
+            # workers notice a dead intake by themselves
+        )
+        process.start()
+        self._processes[index] = process
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    log("worker restarted", logging.WARNING, worker=index, exitcode=process.exitcode)
+                    self.restarts += 1
+                    # a worker killed inside queue.get() leaves the queue's read lock taken
+                    self._queues[index] = self._context.Queue()
+                    self._start_worker(index)
+
+    def dispatch(self, update):
+        key = chat_key(update)
+        self._queues[key % self.workers].put((key, update.model_dump(mode="json", exclude_unset=True, by_alias=True)))
+
+    async def _poll(self, bot, allowed_updates):
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates)
+            except Exception as e:
+                log_error("getUpdates failed", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.dispatch(update)
+                offset = update.update_id + 1
+
+    def _stop_workers(self):
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+    async def run(self):
+        module = importlib.import_module(self.module_name)
+        bot = module.bot
+        for index in range(self.workers):
+            self._start_worker(index)
+        supervisor = asyncio.create_task(self._supervise())
+        poll = asyncio.create_task(self._poll(bot, module.dp.resolve_used_update_types()))
+        with suppress(NotImplementedError):
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                asyncio.get_running_loop().add_signal_handler(sig, poll.cancel)
+        try:
+            await poll
+        except asyncio.CancelledError:
+            # a stop signal cancelled polling, not this coroutine
+            if not poll.cancelled() or asyncio.current_task().cancelling():
+                raise
+            log("intake stopping")
+        finally:
+            poll.cancel()
+            supervisor.cancel()
+            await asyncio.get_running_loop().run_in_executor(None, self._stop_workers)
+            await bot.session.close()
+
+
+if __name__ == '__main__':
+    module_name = sys.argv[1] if len(sys.argv) > 1 else "main_nomanual"
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else SHARD_WORKERS
+    try:
+        asyncio.run(ShardedRunner(module_name, workers).run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+import db
+from config import STATE_TTL, STATE_SWEEP_INTERVAL, FSM_FLUSH_INTERVAL, FSM_CACHE_SIZE, FSM_CACHE
+from log import log_error
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage kept in the fsm_states table of users.db.
+
+    With ``cache``, reads go through a per-process LRU cache and writes are
+    coalesced and flushed every ``flush_interval`` seconds. The cache is
+    never checked against the table, so it is only correct while every chat
+    is handled by one process for good, as with polling and shard.py.
+    Without it, every read comes from the table and every write is committed
+    at once, so a chat may move between processes. Sessions untouched for
+    ``ttl`` seconds are expired.
+    """
+
+    def __init__(self, ttl: float = STATE_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 cache_size: int = FSM_CACHE_SIZE, cache: bool = FSM_CACHE, key_builder: KeyBuilder = None):
+        self.ttl = ttl
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> [state, data, updated_at]
+        self._records = OrderedDict()
+        self._dirty = set()
+        # keys taken by a flush that has not been committed yet
+        self._flushing = set()
+        self._tasks = []
+
+    async def _record(self, key: StorageKey):
+        db_key = self.key_builder.build(key)
+        record = self._records.get(db_key)
+        if record is None or not self.cache and db_key not in self._dirty and db_key not in self._flushing:
+            row = await db.get_fsm_record(db_key)
+            if row is not None and row[2] >= time.time() - self.ttl:
+                loaded = [row[0], json.loads(row[1]), row[2]]
+            else:
+                loaded = [None, {}, time.time()]
+            if self.cache or db_key in self._dirty:
+                # a record loaded or changed meanwhile by another coroutine wins
+                record = self._records.setdefault(db_key, loaded)
+            else:
+                record = self._records[db_key] = loaded
+        self._records.move_to_end(db_key)
+        self._evict(db_key)
+        return db_key, record
+
+    def _evict(self, keep: str):
+        # dirty records and the one being used stay, so the cache may outgrow cache_size until the next flush
+        excess = len(self._records) - self.cache_size
+        if excess <= 0:
+            return
+        for db_key in [db_key for db_key in self._records if db_key not in self._dirty and db_key != keep][:excess]:
+            del self._records[db_key]
+
+    async def _touch(self, db_key: str, record: list):
+        record[2] = time.time()
+        self._dirty.add(db_key)
+        if not self.cache:
+            await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        db_key, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        await self._touch(db_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self._record(key)
+        return record[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        db_key, record = await self._record(key)
+        record[1] = data.copy()
+        await self._touch(db_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self._record(key)
+        return record[1].copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        self._flushing |= dirty
+        records, deleted = [], []
+        for db_key in dirty:
+            state, data, updated_at = self._records[db_key]
+            if state is None and not data:
+                deleted.append(db_key)
+            else:
+                records.append((db_key, state, json.dumps(data, separators=(",", ":"), ensure_ascii=False), updated_at))
+        try:
+            await db.save_fsm_records(records, deleted)
+        except Exception:
+            self._dirty |= dirty
+            raise
+        finally:
+            self._flushing -= dirty
+
+    async def sweep(self):
+        deadline = time.time() - self.ttl
+        expired = [
+            db_key for db_key, (_, _, updated_at) in self._records.items()
+            if updated_at < deadline and db_key not in self._dirty
+        ]
+        for db_key in expired:
+            del self._records[db_key]
+        await db.purge_fsm_records(deadline)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log_error("fsm flush failed", e)
+
+    async def _sweep_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                log_error("fsm sweep failed", e)
+
+    def start(self, sweep_interval: float = STATE_SWEEP_INTERVAL):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._flush_loop()),
+                asyncio.create_task(self._sweep_loop(sweep_interval)),
+            ]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates, SendChatAction, TelegramMethod
+
+from config import SEND_RATE, SEND_CHAT_RATE, SEND_GROUP_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES
+from metrics import counter, histogram
+from ratelimit import TokenBucket
+
+MAX_CHATS = 10000
+# methods that post a new message, the ones Telegram's per-chat and global limits count
+NEW_MESSAGE_METHODS = ("Send", "Forward", "Copy")
+# Telegram shows a chat action for up to 5 seconds
+CHAT_ACTION_TTL = 5
+
+SEND_WAIT_SECONDS = histogram("bot_send_wait_seconds", "Time a Bot API call waited for its rate limits",
+                              (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+class SendThrottle(BaseRequestMiddleware):
+    """Session middleware pacing Bot API calls under Telegram's flood limits.
+
+    Calls posting a new message take a token from their chat's bucket and then
+    from the global one, waiting in line when either is empty; edits, deletes
+    and the rest are not limited. A 429 pauses the chat's bucket and the call
+    is retried after ``retry_after``. Chat actions are not worth waiting for: a
+    repeat within CHAT_ACTION_TTL, or one without a free token, is dropped.
+
+    ``rate`` is the whole bot's; a process sending for the bot together with
+    others keeps to its share (see ``share``). The global bucket holds a
+    single token, so no second sees more than ``rate`` + 1 messages, even
+    after a quiet spell.
+    """
+
+    def __init__(self, rate: float = SEND_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 group_rate: float = SEND_GROUP_RATE, chat_burst: int = SEND_CHAT_BURST,
+                 max_retries: int = SEND_MAX_RETRIES):
+        self.rate = rate
+        self.bucket = TokenBucket(rate, 1)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.dropped = 0
+        self.retries = 0
+        self._chats = OrderedDict()
+        self._chat_actions = {}
+        counter("bot_send_dropped_total", "Chat actions dropped by the send throttle", lambda: self.dropped)
+        counter("bot_send_retries_total", "Bot API calls retried after a 429", lambda: self.retries)
+
+    def share(self, processes: int):
+        """Send at ``1 / processes`` of the global rate, for one of ``processes`` processes of the same bot.
+
+        Chats are not split: each one is served by a single process.
+        """
+        self.bucket = TokenBucket(self.rate / processes, 1)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+            if len(self._chats) > MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _skip_chat_action(self, method: SendChatAction, chat_bucket: TokenBucket) -> bool:
+        key = (method.chat_id, method.action)
+        now = time.monotonic()
+        if now - self._chat_actions.get(key, -CHAT_ACTION_TTL) < CHAT_ACTION_TTL:
+            return True
+        if not chat_bucket.try_acquire() or not self.bucket.try_acquire():
+            return True
+        if len(self._chat_actions) > MAX_CHATS:
+            self._chat_actions = {k: at for k, at in self._chat_actions.items() if now - at < CHAT_ACTION_TTL}
+        self._chat_actions[key] = now
+        return False
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        buckets = []
+        chat_id = getattr(method, "chat_id", None)
+        name = type(method).__name__
+        if chat_id is not None and name.startswith(NEW_MESSAGE_METHODS):
+            chat_bucket = self._chat_bucket(chat_id)
+            if isinstance(method, SendChatAction):
+                if self._skip_chat_action(method, chat_bucket):
+                    self.dropped += 1
+                    return True
+                return await make_request(bot, method)
+            buckets = [chat_bucket, self.bucket]
+        waited = 0.0
+        for attempt in range(self.max_retries + 1):
+            started_at = time.perf_counter()
+            for bucket in buckets:
+                await bucket.acquire()
+            waited += time.perf_counter() - started_at
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                if buckets:
+                    buckets[0].pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+                continue
+            if buckets:
+                SEND_WAIT_SECONDS.observe(waited, method=name)
+            return result
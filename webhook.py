@@ -0,0 +1,104 @@
+import asyncio
+import hmac
+import secrets
+import signal
+from contextlib import suppress
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+from config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_CONCURRENCY,
+                    WEBHOOK_MAX_PENDING, WEBHOOK_DRAIN_TIMEOUT)
+from log import log, log_error
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """aiohttp endpoint that acknowledges updates at once and feeds them to ``dp``.
+
+    Requests without the secret token are refused; without a configured
+    ``secret`` a random one is made for this run. At most ``concurrency``
+    updates are handled at a time. Past ``max_pending`` accepted-but-unfinished
+    updates it answers 503, so Telegram delivers them again later instead of
+    the process queueing without bound.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 concurrency: int = WEBHOOK_CONCURRENCY, max_pending: int = WEBHOOK_MAX_PENDING):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = set()
+        self._accepting = True
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        if not self._accepting or len(self._pending) >= self.max_pending:
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        task = asyncio.create_task(self._process(update))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return web.Response()
+
+    async def _process(self, update: dict):
+        async with self._semaphore:
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                log_error("update failed", e, update_id=update.get("update_id"))
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Stop accepting updates and wait for the ones in flight; those still running after ``timeout`` are cancelled."""
+        self._accepting = False
+        if self._pending:
+            await asyncio.wait(set(self._pending), timeout=timeout)
+        if self._pending:
+            log("webhook drain timed out", cancelled=len(self._pending))
+            for task in self._pending:
+                task.cancel()
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, url: str = WEBHOOK_URL, host: str = WEBHOOK_HOST,
+                      port: int = WEBHOOK_PORT):
+    """Serve updates over a webhook until SIGTERM, SIGINT or cancellation, then finish the ones in flight."""
+    server = WebhookServer(dp, bot)
+    # Telegram delivers to a registered webhook as soon as the port is open,
+    # so the handlers' database and clients have to be up before that
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    with suppress(NotImplementedError):
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+    runner = web.AppRunner(server.app())
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        await bot.set_webhook(
+            url=url.rstrip("/") + server.path,
+            secret_token=server.secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        log("webhook listening", host=host, port=port, path=server.path)
+        await stop.wait()
+        log("webhook stopping")
+    finally:
+        await server.drain()
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        await bot.session.close()
@@ -0,0 +1,259 @@
+import asyncio
+import datetime
+import io
+import math
+import multiprocessing
+import os
+import zipfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import openpyxl
+
+from config import (WORKBOOK_MAX_BYTES, WORKBOOK_MAX_UNPACKED, WORKBOOK_MAX_SHEETS, WORKBOOK_MAX_ROWS,
+                    WORKBOOK_WORKERS, WORKBOOK_CACHE_SIZE)
+from files import spool
+from metrics import counter, span
+
+MAX_HOURS = 366 * 24
+MIN_HOURS = 24
+# a stamp is looked for in the first cells of a row only
+STAMP_COLUMNS = 3
+DATE_FORMATS = ("%d.%m.%Y", "%d.%m.%Y %H:%M", "%d.%m.%Y %H:%M:%S", "%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S")
+
+
+class WorkbookError(ValueError):
+    """The upload is not a readable meter readings workbook; the message is shown to the user."""
+
+
+class HourlyProfile:
+    """Hourly consumption in kWh from ``start``, one float32 per hour, NaN where a reading is missing."""
+
+    __slots__ = ("start", "values")
+
+    def __init__(self, start: datetime.datetime, values: array):
+        self.start = start
+        self.values = values
+
+    @property
+    def hours(self) -> int:
+        return len(self.values)
+
+    @property
+    def missing(self) -> int:
+        return sum(1 for value in self.values if math.isnan(value))
+
+    @property
+    def total(self) -> float:
+        return math.fsum(value for value in self.values if not math.isnan(value))
+
+
+def _as_datetime(cell):
+    if isinstance(cell, datetime.datetime):
+        return cell
+    if isinstance(cell, datetime.date):
+        return datetime.datetime(cell.year, cell.month, cell.day)
+    if isinstance(cell, str) and 8 <= len(cell) <= 19 and cell[:1].isdigit():
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(cell.strip(), date_format)
+            except ValueError:
+                continue
+    return None
+
+
+def _as_number(cell):
+    if isinstance(cell, bool):
+        return None
+    if isinstance(cell, (int, float)):
+        return float(cell)
+    if isinstance(cell, str):
+        try:
+            return float(cell.replace(",", ".").replace("\xa0", "").replace(" ", ""))
+        except ValueError:
+            return None
+    return None
+
+
+def _check_archive(source, max_bytes: int, max_unpacked: int, max_sheets: int):
+    """Reject what is obviously not a usable .xlsx before the workbook is parsed."""
+    if isinstance(source, bytes):
+        size, header, archive_file = len(source), source[:4], io.BytesIO(source)
+    else:
+        size, archive_file = os.path.getsize(source), source
+        with open(source, "rb") as f:
+            header = f.read(4)
+    if size > max_bytes:
+        raise WorkbookError(f"файл больше {max_bytes // (1024 * 1024)} МБ")
+    if header != b"PK\x03\x04":
+        raise WorkbookError("это не файл .xlsx")
+    try:
+        with zipfile.ZipFile(archive_file) as archive:
+            entries = archive.infolist()
+    except zipfile.BadZipFile:
+        raise WorkbookError("файл повреждён") from None
+    names = {entry.filename for entry in entries}
+    if "xl/workbook.xml" not in names:
+        raise WorkbookError("это не файл .xlsx")
+    if sum(entry.file_size for entry in entries) > max_unpacked:
+        raise WorkbookError("таблица слишком большая")
+    sheets = sum(1 for name in names if name.startswith("xl/worksheets/sheet"))
+    if sheets > max_sheets:
+        raise WorkbookError(f"в файле {sheets} листов, нужен один лист с показаниями")
+
+
+def parse_workbook(source, max_bytes: int = WORKBOOK_MAX_BYTES, max_unpacked: int = WORKBOOK_MAX_UNPACKED,
+                   max_sheets: int = WORKBOOK_MAX_SHEETS, max_rows: int = WORKBOOK_MAX_ROWS) -> HourlyProfile:
+    """Read the hourly series from the first sheet, row by row.
+
+    Rows are either a day (a date followed by 24 hourly values), a date, an
+    hour number and a value, or a date with time and a value. Other rows,
+    such as headers and totals, are skipped. ``source`` is the file's bytes
+    or its path.
+    """
+    _check_archive(source, max_bytes, max_unpacked, max_sheets)
+    try:
+        book = openpyxl.load_workbook(io.BytesIO(source) if isinstance(source, bytes) else source,
+                                      read_only=True, data_only=True)
+    except Exception:
+        raise WorkbookError("файл повреждён") from None
+    # hour index since 0001-01-01 and reading; rows with an hour number are remembered
+    # in hour_columns, as 1..24 numbering shows only once the whole sheet is read
+    hours, readings, hour_columns = array("q"), array("f"), []
+    last_hour = 0
+    try:
+        for row_number, row in enumerate(book.worksheets[0].iter_rows(values_only=True), start=1):
+            if row_number > max_rows:
+                raise WorkbookError(f"в таблице больше {max_rows} строк")
+            for column, cell in enumerate(row[:STAMP_COLUMNS]):
+                stamp = _as_datetime(cell)
+                if stamp is not None:
+                    break
+            else:
+                continue
+            numbers = [number for number in map(_as_number, row[column + 1:]) if number is not None]
+            if not numbers:
+                continue
+            base = stamp.toordinal() * 24
+            if len(numbers) >= 24:
+                hours.extend(range(base, base + 24))
+                readings.extend(numbers[:24])
+            elif len(numbers) >= 2 and stamp.hour == 0 and numbers[0].is_integer() and 0 <= numbers[0] <= 24:
+                hour_columns.append(len(hours))
+                last_hour = max(last_hour, int(numbers[0]))
+                hours.append(base + int(numbers[0]))
+                readings.append(numbers[1])
+            else:
+                hours.append(base + stamp.hour)
+                readings.append(numbers[0])
+    finally:
+        book.close()
+    if last_hour == 24:
+        # hour numbers run 1..24, hour 24 being the last hour of the same day
+        for index in hour_columns:
+            hours[index] -= 1
+    if len(hours) < MIN_HOURS:
+        raise WorkbookError("в файле не нашлось почасовых показаний")
+    first, last = min(hours), max(hours)
+    if last - first + 1 > MAX_HOURS:
+        raise WorkbookError("показания охватывают больше года")
+    if min(readings) < 0:
+        raise WorkbookError("в файле есть отрицательные показания")
+    values = array("f", [math.nan]) * (last - first + 1)
+    for hour, reading in zip(hours, readings):
+        values[hour - first] = reading
+    start = datetime.datetime.fromordinal(first // 24) + datetime.timedelta(hours=first % 24)
+    return HourlyProfile(start, values)
+
+
+def profile_to_xlsx(profile: HourlyProfile) -> bytes:
+    """A minimal workbook with one row per day: the date and 24 hourly values."""
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet("Показания")
+    sheet.append(["Дата"] + list(range(1, 25)))
+    offset = profile.start.hour
+    padded = [math.nan] * offset + profile.values.tolist()
+    day = profile.start.date()
+    for index in range(0, len(padded), 24):
+        hourly = [None if math.isnan(value) else value for value in padded[index:index + 24]]
+        sheet.append([day] + hourly + [None] * (24 - len(hourly)))
+        day += datetime.timedelta(days=1)
+    output = io.BytesIO()
+    book.save(output)
+    return output.getvalue()
+
+
+def _ready() -> bool:
+    return True
+
+
+class WorkbookReader:
+    """Validates uploaded workbooks off the event loop and remembers recent profiles.
+
+    Parsing runs in a pool of ``workers`` processes (a thread when 0), so it
+    neither blocks the event loop nor holds its GIL. Profiles are kept by
+    content key (see files.content_key) for the later steps of the dialog.
+    """
+
+    def __init__(self, workers: int = WORKBOOK_WORKERS, cache_size: int = WORKBOOK_CACHE_SIZE):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.rejected = 0
+        self._profiles = OrderedDict()
+        self._pool = None
+
+    async def start(self):
+        counter("bot_workbooks_rejected_total", "Uploaded workbooks refused by validation", lambda: self.rejected)
+        if self.workers and self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            # spawn the workers before the first upload, starting one takes seconds
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self._pool, _ready) for _ in range(self.workers)))
+
+    async def close(self):
+        if self._pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._pool.shutdown)
+            self._pool = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        if self._pool is None:
+            return await loop.run_in_executor(None, func, *args)
+        return await loop.run_in_executor(self._pool, func, *args)
+
+    def cached(self, key: str):
+        """The profile already read for ``key``, or None."""
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+        return profile
+
+    async def profile(self, key: str, file_data) -> HourlyProfile:
+        """Hourly profile of the workbook ``file_data``: bytes, a chunk stream or a callable opening one.
+
+        A stream is spooled to a temporary file first, so a large upload does
+        not sit in memory and only its path goes to the pool. Raises WorkbookError.
+        """
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+            return profile
+        source = file_data if isinstance(file_data, bytes) else await spool(file_data)
+        try:
+            with span("workbook_parse"):
+                try:
+                    profile = await self._run(parse_workbook, source)
+                except WorkbookError:
+                    self.rejected += 1
+                    raise
+        finally:
+            if not isinstance(source, bytes):
+                os.unlink(source)
+        self._profiles[key] = profile
+        if len(self._profiles) > self.cache_size:
+            self._profiles.popitem(last=False)
+        return profile
+
+    async def compact(self, profile: HourlyProfile) -> bytes:
+        return await self._run(profile_to_xlsx, profile)